@@ -1,24 +1,258 @@
-from Board import Board
-
-
-def alpha_beta_search(board, depth, alpha=-float('inf'), beta=float('inf'), side=None):
-    if side is None:
-        side = 1 if board.is_white_to_move() else -1
-    if board.is_game_over():
-        return side * board.get_game_result(), None
-    if depth == 0:
-        return side * 0, None  # Change to eval function
-    max_eval = -float('inf')
-    best_move = None
-    for m in board.get_moves():
-        board.move(m)
-        e = -alpha_beta_search(board, depth - 1, -beta, -alpha, -side)[0]
-        board.un_move()
-        if e > max_eval:
-            max_eval = e
-            best_move = m
-        alpha = max(alpha, max_eval)
-        if alpha >= beta:
+import time
+import numpy as np
+
+from Board import Board, FLAT_INDEX
+from LookupTables import board_count
+from TranspositionTable import TranspositionTable
+
+WIN_SCORE = 10000
+# Scores beyond this bound are wins, shifted by the ply the game ends at
+WIN_BOUND = WIN_SCORE - 100
+
+# Bound types of the transposition table entries
+EXACT = 0
+LOWER = 1
+UPPER = 2
+
+LINES = (0b000000111, 0b000111000, 0b111000000, 0b001001001, 0b010010010, 0b100100100, 0b100010001, 0b001010100)
+
+
+def compute_two_in_a_rows():
+    """
+    Counts the lines holding two own pieces and no opposing piece for every pair of 9-bit BitBoards
+    :return: A bytes table indexed by (own << 9) | other
+    """
+    own = np.arange(board_count)[:, None]
+    other = np.arange(board_count)[None, :]
+    counts = np.zeros((board_count, board_count), dtype=np.uint8)
+    for line in LINES:
+        pieces = np.array([bin(b & line).count('1') for b in range(board_count)])
+        counts += (pieces[own] == 2) & ((other & line) == 0)
+    return counts.tobytes()
+
+
+# TWO_IN_A_ROW[(own << 9) | other]: open lines of a BitBoard one move away from a win
+TWO_IN_A_ROW = compute_two_in_a_rows()
+POPCOUNT = tuple(bin(b).count('1') for b in range(board_count))
+
+GLOBAL_TWO_WEIGHT = 40
+BLOCK_WEIGHT = 25
+CENTER_BLOCK_WEIGHT = 10
+LOCAL_TWO_WEIGHT = 3
+
+
+def evaluate(board: Board):
+    """
+    Cheap static evaluation from local board wins and two-in-a-rows
+    :param board: The board to evaluate
+    :return: The score from the point of view of the side to move
+    """
+    global_white = board.global_white
+    global_black = board.global_black
+    # Drawn blocks block the global lines of both sides
+    blocked = board.decided & ~(global_white | global_black)
+    score = GLOBAL_TWO_WEIGHT * (TWO_IN_A_ROW[(global_white << 9) | global_black | blocked] -
+                                 TWO_IN_A_ROW[(global_black << 9) | global_white | blocked])
+    score += BLOCK_WEIGHT * (POPCOUNT[global_white] - POPCOUNT[global_black])
+    score += CENTER_BLOCK_WEIGHT * (((global_white >> 4) & 1) - ((global_black >> 4) & 1))
+    white = board.white
+    black = board.black
+    for i in range(9):
+        if not (board.decided >> i) & 1:
+            score += LOCAL_TWO_WEIGHT * (TWO_IN_A_ROW[(white[i] << 9) | black[i]] -
+                                         TWO_IN_A_ROW[(black[i] << 9) | white[i]])
+    return score if board.is_white_to_move() else -score
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+class AlphaBetaSearch:
+    """
+    Negamax alpha beta search with a transposition table, killer moves and the history heuristic
+    """
+
+    def __init__(self, tt: TranspositionTable = None, deadline=float('inf')):
+        """
+        :param tt: Optional TranspositionTable of (depth, bound, score, move) entries kept between searches
+        :param deadline: Time after which the search raises SearchTimeout
+        """
+        self.tt = TranspositionTable() if tt is None else tt
+        self.deadline = deadline
+        self.killers = [[None, None] for _ in range(82)]
+        self.history = [0] * 81
+        self.nodes = 0
+
+    def search(self, board: Board, depth, alpha=-float('inf'), beta=float('inf'), ply=0):
+        """
+        :param board: The board to search, restored after the search
+        :param depth: Remaining depth in plies
+        :param alpha: Lower bound of the window
+        :param beta: Upper bound of the window
+        :param ply: Distance from the root, used for killer moves and to prefer faster wins
+        :return: A tuple of the score for the side to move and the best move
+        """
+        self.nodes += 1
+        if not self.nodes & 1023 and time.time() > self.deadline:
+            raise SearchTimeout()
+        if board.is_game_over():
+            result = board.get_game_result()
+            if result == 0:
+                return 0, None
+            side = 1 if board.is_white_to_move() else -1
+            return side * result * (WIN_SCORE - ply), None
+        if depth == 0:
+            return evaluate(board), None
+
+        original_alpha = alpha
+        tt_move = None
+        entry = self.tt.probe(board.hash)
+        if entry is not None:
+            entry_depth, bound, score, tt_move = entry
+            if entry_depth >= depth:
+                score = score_from_tt(score, ply)
+                if bound == EXACT:
+                    return score, tt_move
+                if bound == LOWER:
+                    alpha = max(alpha, score)
+                else:
+                    beta = min(beta, score)
+                if alpha >= beta:
+                    return score, tt_move
+
+        max_eval = -float('inf')
+        best_move = None
+        for m in self.order_moves(board.get_moves(), tt_move, ply):
+            board.move(m)
+            try:
+                e = -self.search(board, depth - 1, -beta, -alpha, ply + 1)[0]
+            finally:
+                board.un_move()
+            if e > max_eval:
+                max_eval = e
+                best_move = m
+            alpha = max(alpha, max_eval)
+            if alpha >= beta:
+                self.add_cutoff(m, depth, ply)
+                break
+
+        if max_eval <= original_alpha:
+            bound = UPPER
+        elif max_eval >= beta:
+            bound = LOWER
+        else:
+            bound = EXACT
+        self.tt.store(board.hash, (depth, bound, score_to_tt(max_eval, ply), best_move))
+        return max_eval, best_move
+
+    def order_moves(self, moves, tt_move, ply):
+        """
+        Orders moves by the TT move, the killer moves of the ply and the history heuristic
+        """
+        killers = self.killers[ply]
+        history = self.history
+
+        def key(m):
+            if m == tt_move:
+                return 1 << 30
+            if m == killers[0]:
+                return 1 << 29
+            if m == killers[1]:
+                return 1 << 28
+            return history[FLAT_INDEX[m]]
+
+        return sorted(moves, key=key, reverse=True)
+
+    def add_cutoff(self, m, depth, ply):
+        killers = self.killers[ply]
+        if killers[0] != m:
+            killers[1] = killers[0]
+            killers[0] = m
+        self.history[FLAT_INDEX[m]] += depth * depth
+
+
+def score_to_tt(score, ply):
+    # Wins are stored relative to the node so they stay valid at other plies
+    if score > WIN_BOUND:
+        return score + ply
+    if score < -WIN_BOUND:
+        return score - ply
+    return score
+
+
+def score_from_tt(score, ply):
+    if score > WIN_BOUND:
+        return score - ply
+    if score < -WIN_BOUND:
+        return score + ply
+    return score
+
+
+def alpha_beta_search(board, timeout=5, max_depth=81, tt=None, verbose=True, solver=None):
+    """
+    Iterative deepening alpha beta search under a time budget
+    :param board: The board to search
+    :param timeout: Timeout duration in seconds, the deepest completed iteration is used
+    :param max_depth: Max search depth in plies
+    :param tt: Optional TranspositionTable kept between searches
+    :param verbose: Print the statistics of every iteration
+    :param solver: Optional EndgameSolver the search is handed off to when few empty cells are left
+    :return: A tuple of the score for the side to move, the best move and a list of per depth statistics
+    """
+    start = time.time()
+    board = Board(board)
+    if solver is not None and solver.is_endgame(board):
+        result, move = solver.solve(board)
+        if result is not None:
+            # The distance to the end of the game is unknown, proven wins get the lowest win score
+            score = result * (1 if board.is_white_to_move() else -1) * (WIN_BOUND + 1)
+            if verbose:
+                print("Solved Score:{} Move:{} Time:{:0.2f}".format(score, move, time.time() - start))
+            return score, move, []
+    searcher = AlphaBetaSearch(tt, deadline=start + timeout)
+    score, best_move = 0, None
+    stats = []
+    max_depth = min(max_depth, 81 - board.plies())
+    for depth in range(1, max_depth + 1):
+        nodes = searcher.nodes
+        depth_start = time.time()
+        try:
+            score, m = searcher.search(board, depth)
+        except SearchTimeout:
+            break
+        best_move = m
+        depth_nodes = searcher.nodes - nodes
+        depth_time = time.time() - depth_start
+        # Effective branching factor as the growth of the tree between consecutive iterations
+        stats.append({"depth": depth,
+                      "score": score,
+                      "move": best_move,
+                      "nodes": depth_nodes,
+                      "time": depth_time,
+                      "nps": depth_nodes / depth_time if depth_time > 0 else float('inf'),
+                      "ebf": depth_nodes / stats[-1]["nodes"] if len(stats) > 0 else float(depth_nodes)})
+        if verbose:
+            print("Depth:{depth} Score:{score} Move:{move} Nodes:{nodes} Time:{time:0.2f} NPS:{nps:0.2f} "
+                  "EBF:{ebf:0.2f}".format(**stats[-1]))
+        if abs(score) > WIN_BOUND:
             break
+    if best_move is None and not board.is_game_over():
+        best_move = board.get_moves()[0]
+    return score, best_move, stats
+
+
+if __name__ == '__main__':
+    from EndgameSolver import EndgameSolver
 
-    return max_eval, best_move
+    b = Board()
+    tt = TranspositionTable(1 << 20)
+    solver = EndgameSolver()
+    while not b.is_game_over():
+        print(b)
+        _, move, _ = alpha_beta_search(b, timeout=5, tt=tt, solver=solver)
+        b.move(move)
+    print(b)
+    print(b.get_game_result())
+    print(tt)
+    print(solver)
@@ -0,0 +1,303 @@
+"""
+Arena playing matches between two engines over a process pool.
+Games are played in pairs from the same random opening with the colors swapped, the match stops as soon as
+a sequential probability ratio test on the Elo difference accepts or rejects the candidate.
+"""
+import json
+import math
+import multiprocessing as mp
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from Board import Board
+from MCTNode import MCTSNode, get_last_move
+from MCTSearch import mst_search, get_best_child
+from NNSearch import nn_search
+from AlphaBetaSearch import alpha_beta_search
+from TranspositionTable import TranspositionTable
+from TimeManager import TimeManager
+
+ENGINES = ("mst", "nn", "alpha_beta")
+# Networks loaded by the worker process, by model file
+networks = {}
+
+
+class Engine:
+    """
+    Picklable description of an engine and its per-move budget
+    """
+
+    def __init__(self, kind, model_file=None, timeout=1.0, max_nodes=1e3, max_depth=81, batch_size=8,
+                 time_control=None):
+        """
+        :param kind: "mst" for mst_search, "nn" for nn_search, "alpha_beta" for alpha_beta_search
+        :param model_file: Model file of the network of nn_search, see SelfPlay.load_network
+        :param timeout: Timeout duration per move in seconds
+        :param max_nodes: Max nodes searched per move by mst_search and nn_search
+        :param max_depth: Max search depth of alpha_beta_search
+        :param batch_size: Leaves evaluated per call to the neural network by nn_search
+        :param time_control: Optional (seconds per game, increment per move) clock managed by a TimeManager,
+                             replacing the timeout, the engine loses when its clock runs out
+        """
+        if kind not in ENGINES:
+            raise ValueError("Unknown engine {}".format(kind))
+        self.kind = kind
+        self.model_file = model_file
+        self.timeout = timeout
+        self.max_nodes = max_nodes
+        self.max_depth = max_depth
+        self.batch_size = batch_size
+        self.time_control = time_control
+
+    def __str__(self):
+        if self.kind == "nn":
+            return "nn({})".format(self.model_file)
+        return self.kind
+
+    def player(self, board):
+        return Player(self, board)
+
+
+class Player:
+    """
+    An engine playing one game, mst and nn keep their tree between moves, alpha_beta its TranspositionTable
+    """
+
+    def __init__(self, engine: Engine, board):
+        self.engine = engine
+        self.root = MCTSNode(board) if engine.kind in ("mst", "nn") else None
+        self.tt = TranspositionTable(1 << 20) if engine.kind == "alpha_beta" else None
+        self.clock = None if engine.time_control is None else TimeManager(*engine.time_control)
+        self.nn = None
+        if engine.kind == "nn":
+            if engine.model_file not in networks:
+                from SelfPlay import load_network
+
+                networks[engine.model_file] = load_network(engine.model_file)
+            self.nn = networks[engine.model_file]
+
+    def get_move(self, board):
+        engine = self.engine
+        timeout = engine.timeout
+        stop = None
+        if self.clock is not None:
+            timer = self.clock.start_move(board)
+            # alpha_beta_search cannot stop early on its own, it gets the target budget
+            timeout = timer.target if engine.kind == "alpha_beta" else timer.maximum
+            stop = timer.should_stop
+        if engine.kind == "alpha_beta":
+            move = alpha_beta_search(board, timeout=timeout, max_depth=engine.max_depth, tt=self.tt,
+                                     verbose=False)[1]
+        else:
+            if engine.kind == "nn":
+                self.root = nn_search(self.root, self.nn, timeout=timeout, max_nodes=engine.max_nodes,
+                                      batch_size=engine.batch_size, verbose=False, stop=stop)
+            else:
+                self.root = mst_search(self.root, timeout=timeout, max_nodes=engine.max_nodes, stop=stop)
+            move = get_last_move(get_best_child(self.root))
+        if self.clock is not None:
+            self.clock.end_move()
+        return move
+
+    def is_flagged(self):
+        return self.clock is not None and self.clock.is_flagged()
+
+    def advance(self, move):
+        if self.root is not None:
+            self.root = self.root.advance(move)
+
+
+def random_opening(plies, seed):
+    """
+    :param plies: Number of random moves
+    :param seed: Seed of the moves
+    :return: A list of moves in tuple form
+    """
+    rng = random.Random(seed)
+    b = Board()
+    for _ in range(plies):
+        if b.is_game_over():
+            break
+        moves = b.get_moves()
+        b.move(moves[rng.randrange(len(moves))])
+    return b.move_list
+
+
+def play_game(white: Engine, black: Engine, opening, seed):
+    """
+    Plays a game between two engines in a worker process
+    :param white: The engine playing white
+    :param black: The engine playing black
+    :param opening: The moves played before the engines take over
+    :param seed: Seed of the searches
+    :return: The result from white's perspective and the moves played, a player whose clock runs out loses
+    """
+    random.seed(seed)
+    b = Board()
+    for move in opening:
+        b.move(move)
+    players = [white.player(b), black.player(b)]
+    while not b.is_game_over():
+        player = players[0 if b.is_white_to_move() else 1]
+        move = player.get_move(b)
+        if player.is_flagged():
+            return -1 if b.is_white_to_move() else 1, b.move_list
+        b.move(move)
+        for player in players:
+            player.advance(move)
+    return b.get_game_result(), b.move_list
+
+
+def expected_score(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+
+def score_to_elo(score):
+    score = min(max(score, 1e-6), 1 - 1e-6)
+    return -400 * math.log10(1 / score - 1)
+
+
+def score_statistics(wins, draws, losses):
+    """
+    :return: The mean score of a game and the variance of the score of a game
+    """
+    n = wins + draws + losses
+    score = (wins + draws / 2) / n
+    variance = (wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score ** 2) / n
+    return score, variance
+
+
+def regularized_variance(wins, draws, losses):
+    # Half a game of every outcome keeps the variance of one-sided results like 3-0-0 from vanishing
+    return score_statistics(wins + 0.5, draws + 0.5, losses + 0.5)[1]
+
+
+def elo_estimate(wins, draws, losses, z=1.96):
+    """
+    Elo difference of a match with a confidence interval from the normal approximation of the score
+    :param z: Quantile of the interval, 1.96 for 95%
+    :return: A tuple of the Elo difference and the lower and upper bounds of the interval
+    """
+    n = wins + draws + losses
+    if n == 0:
+        return 0.0, -float('inf'), float('inf')
+    score, _ = score_statistics(wins, draws, losses)
+    variance = regularized_variance(wins, draws, losses)
+    error = z * math.sqrt(variance / n)
+    return score_to_elo(score), score_to_elo(score - error), score_to_elo(score + error)
+
+
+def sprt_llr(wins, draws, losses, elo0, elo1):
+    """
+    Log likelihood ratio of the hypotheses elo1 against elo0, with the score of a game approximated as normal
+    """
+    n = wins + draws + losses
+    if n == 0:
+        return 0.0
+    score, _ = score_statistics(wins, draws, losses)
+    variance = regularized_variance(wins, draws, losses)
+    s0 = expected_score(elo0)
+    s1 = expected_score(elo1)
+    return (s1 - s0) * (2 * score - s0 - s1) / (2 * variance / n)
+
+
+def sprt_bounds(alpha, beta):
+    """
+    :param alpha: Probability of accepting elo1 when elo0 holds
+    :param beta: Probability of accepting elo0 when elo1 holds
+    :return: The lower and upper bounds of the log likelihood ratio
+    """
+    return math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+
+
+def run_match(candidate: Engine, baseline: Engine, games=400, workers=4, elo0=0.0, elo1=20.0, alpha=0.05,
+              beta=0.05, opening_plies=2, seed=0, records=None, verbose=True):
+    """
+    Plays a match between a candidate and a baseline engine
+    :param candidate: The engine under test
+    :param baseline: The reference engine
+    :param games: Max number of games, rounded up to an even number
+    :param workers: Number of worker processes
+    :param elo0: Elo difference of the null hypothesis
+    :param elo1: Elo difference of the alternative hypothesis
+    :param alpha: False positive rate of the SPRT
+    :param beta: False negative rate of the SPRT
+    :param opening_plies: Number of random moves of the opening shared by a pair of games
+    :param seed: Seed of the openings and searches
+    :param records: Optional GameRecordWriter every game is recorded to
+    :param verbose: Print the standing after every game
+    :return: A dict of the match report, see write_decision
+    """
+    lower, upper = sprt_bounds(alpha, beta)
+    score = {"wins": 0, "draws": 0, "losses": 0}
+    llr = 0.0
+    sprt = None
+    start = time.time()
+    pool = ProcessPoolExecutor(workers, mp_context=mp.get_context('spawn'))
+    try:
+        futures = {}
+        for pair in range((games + 1) // 2):
+            opening = random_opening(opening_plies, seed + pair)
+            # The candidate plays white in the first game of the pair and black in the second
+            futures[pool.submit(play_game, candidate, baseline, opening, seed + 2 * pair)] = 1
+            futures[pool.submit(play_game, baseline, candidate, opening, seed + 2 * pair + 1)] = -1
+        pending = set(futures)
+        while len(pending) > 0 and sprt is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                result, moves = future.result()
+                if records is not None:
+                    records.add_game(moves, result)
+                result *= futures[future]
+                score["wins" if result == 1 else "draws" if result == 0 else "losses"] += 1
+            llr = sprt_llr(score["wins"], score["draws"], score["losses"], elo0, elo1)
+            if llr >= upper:
+                sprt = "H1"
+            elif llr <= lower:
+                sprt = "H0"
+            if verbose:
+                print("Games:{} Wins:{wins} Draws:{draws} Losses:{losses} LLR:{:0.2f} [{:0.2f}, {:0.2f}]".format(
+                    sum(score.values()), llr, lower, upper, **score))
+    finally:
+        # Returns without waiting for the games still running once the SPRT stopped, their results are discarded
+        pool.shutdown(wait=False, cancel_futures=True)
+    elo, elo_lower, elo_upper = elo_estimate(score["wins"], score["draws"], score["losses"])
+    return {"candidate": str(candidate),
+            "baseline": str(baseline),
+            "games": sum(score.values()),
+            **score,
+            "elo": elo,
+            "elo_lower": elo_lower,
+            "elo_upper": elo_upper,
+            "llr": llr,
+            "llr_bounds": [lower, upper],
+            "elo0": elo0,
+            "elo1": elo1,
+            "sprt": sprt,
+            "promote": sprt == "H1",
+            "time": time.time() - start}
+
+
+def write_decision(filename, report):
+    """
+    Writes the gating decision of a match, the candidate is promoted only when the SPRT accepted elo1
+    :param filename: The JSON file to write
+    :param report: The report of run_match
+    """
+    # Written under a temporary name and renamed, a training loop polling the file never reads a partial one
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w') as f:
+        json.dump({**report, "created": time.strftime("%Y-%m-%dT%H:%M:%S")}, f, indent=2)
+    os.replace(tmp_filename, filename)
+
+
+if __name__ == '__main__':
+    # Arena.py <candidate model> <baseline model> [decision file]
+    candidate_engine = Engine("nn", sys.argv[1], timeout=float('inf'), max_nodes=800)
+    baseline_engine = Engine("nn", sys.argv[2], timeout=float('inf'), max_nodes=800)
+    match = run_match(candidate_engine, baseline_engine)
+    print("Elo:{elo:0.1f} [{elo_lower:0.1f}, {elo_upper:0.1f}] SPRT:{sprt} Promote:{promote}".format(**match))
+    write_decision(sys.argv[3] if len(sys.argv) > 3 else "gating.json", match)
@@ -0,0 +1,79 @@
+"""
+Random rollouts of many games at once.
+The games are stored as NumPy arrays of BitBoards and every step plays one random
+move in each unfinished game with vectorized table lookups, see Board.move for the rules.
+"""
+import numpy as np
+
+from LookupTables import WON, FULL, board_count, board_mask
+
+BLOCKS = np.arange(9)
+WON_TABLE = np.array(WON, dtype=bool)
+FULL_TABLE = np.array(FULL, dtype=bool)
+# POPCOUNT[board]: number of set bits of a 9-bit BitBoard
+POPCOUNT = np.array([bin(b).count('1') for b in range(board_count)], dtype=np.int64)
+# NTH_BIT[board][n]: index of the n-th set bit of a 9-bit BitBoard, -1 past the last one
+NTH_BIT = np.array([[i for i in range(9) if (b >> i) & 1] + [-1] * (9 - POPCOUNT[b]) for b in range(board_count)],
+                   dtype=np.int64)
+
+
+def stimulate_batch(boards, rollouts=1, rng=None):
+    """
+    Plays random games to the end from several boards at once
+    :param boards: A list of boards to start from
+    :param rollouts: Number of random games played from every board, or a sequence of counts per board
+    :param rng: Optional numpy Generator of the random moves
+    :return: A numpy array of the game results of all rollouts from white's perspective,
+             the rollouts of each board are consecutive
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    white = np.repeat(np.array([b.white for b in boards], dtype=np.int64).reshape((-1, 9)), rollouts, axis=0)
+    black = np.repeat(np.array([b.black for b in boards], dtype=np.int64).reshape((-1, 9)), rollouts, axis=0)
+    global_white = np.repeat(np.array([b.global_white for b in boards], dtype=np.int64), rollouts)
+    global_black = np.repeat(np.array([b.global_black for b in boards], dtype=np.int64), rollouts)
+    decided = np.repeat(np.array([b.decided for b in boards], dtype=np.int64), rollouts)
+    active = np.repeat(np.array([b.active_block[-1] for b in boards], dtype=np.int64), rollouts)
+    plies = np.repeat(np.array([b.plies() for b in boards], dtype=np.int64), rollouts)
+    results = np.repeat(np.array([0 if b.result is None else b.result for b in boards], dtype=np.int8), rollouts)
+    games = np.repeat(np.array([b.result is None for b in boards], dtype=bool), rollouts)
+
+    index = np.flatnonzero(games)
+    while len(index) > 0:
+        rows = np.arange(len(index))
+        occupied = white[index] | black[index]
+        game_active = active[index]
+        game_decided = decided[index]
+        playable = np.where(game_active[:, None] == -1,
+                            (game_decided[:, None] >> BLOCKS) & 1 == 0,
+                            BLOCKS == game_active[:, None])
+        counts = np.where(playable, POPCOUNT[occupied ^ board_mask], 0)
+        total = np.cumsum(counts, axis=1)
+        choice = (rng.random(len(index)) * total[:, -1]).astype(np.int64)
+        block = np.count_nonzero(total <= choice[:, None], axis=1)
+        block_occupied = occupied[rows, block]
+        cell = NTH_BIT[block_occupied ^ board_mask, choice - total[rows, block] + counts[rows, block]]
+        block_bit = 1 << block
+
+        white_to_move = plies[index] & 1 == 0
+        own = np.where(white_to_move, white[index, block], black[index, block]) | (1 << cell)
+        white[index[white_to_move], block[white_to_move]] = own[white_to_move]
+        black[index[~white_to_move], block[~white_to_move]] = own[~white_to_move]
+
+        block_won = WON_TABLE[own]
+        game_white = np.where(block_won & white_to_move, global_white[index] | block_bit, global_white[index])
+        game_black = np.where(block_won & ~white_to_move, global_black[index] | block_bit, global_black[index])
+        global_white[index] = game_white
+        global_black[index] = game_black
+        game_decided |= np.where(block_won | FULL_TABLE[block_occupied | (1 << cell)], block_bit, 0)
+        decided[index] = game_decided
+        game_active = np.where((game_decided >> cell) & 1 == 1, -1, cell)
+        active[index] = game_active
+        game_plies = plies[index] + 1
+        plies[index] = game_plies
+
+        won = block_won & WON_TABLE[np.where(white_to_move, game_white, game_black)]
+        drawn = ~won & (((game_active == -1) & (game_decided == board_mask)) | (game_plies == 80))
+        results[index[won]] = np.where(white_to_move[won], 1, -1)
+        results[index[drawn]] = 0
+        index = index[~(won | drawn)]
+    return results
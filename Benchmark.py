@@ -0,0 +1,196 @@
+import json
+import platform
+import random
+import sys
+import time
+import numpy as np
+
+from Board import Board, boards_to_numpy
+from MCTNode import MCTSNode
+from BatchRollout import stimulate_batch
+from MCTSearch import mst_search, stimulate
+
+
+def random_position(seed, plies):
+    """
+    Plays random moves from the start position
+    :param seed: Seed of the random moves
+    :param plies: Number of moves played, fewer if the game ends first
+    :return: The resulting Board
+    """
+    rng = random.Random(seed)
+    board = Board()
+    while board.plies() < plies and not board.is_game_over():
+        moves = board.get_moves()
+        board.move(moves[rng.randrange(len(moves))])
+    return board
+
+
+def benchmark_mcts(plies=(0, 20, 40), iterations=3000, seed=1, repeat=3):
+    """
+    Measures mst_search iterations per second on fixed positions with a fixed seed
+    :param plies: Number of random plies of each benchmark position
+    :param iterations: MCTS iterations per position
+    :param seed: Seed of the positions and the rollouts
+    :param repeat: Number of runs per position, the fastest one is reported
+    :return: A dict of iterations per second keyed by plies
+    """
+    results = {}
+    for p in plies:
+        board = random_position(seed, p)
+        for _ in range(repeat):
+            random.seed(seed)
+            start = time.perf_counter()
+            root = mst_search(MCTSNode(board), timeout=float('inf'), max_nodes=iterations)
+            results[p] = max(results.get(p, 0), root.visits / (time.perf_counter() - start))
+    return results
+
+
+def benchmark_rollouts(batch_sizes=(1, 64, 1024), rollouts=4096, plies=20, seed=1, repeat=3):
+    """
+    Measures random rollouts per second of stimulate and of stimulate_batch for several batch sizes
+    :param batch_sizes: Number of games played together by stimulate_batch, 1 measures stimulate
+    :param rollouts: Number of rollouts per run
+    :param plies: Number of random plies of the start position
+    :param seed: Seed of the position and the rollouts
+    :param repeat: Number of runs per batch size, the fastest one is reported
+    :return: A dict of rollouts per second keyed by batch size
+    """
+    board = random_position(seed, plies)
+    results = {}
+    for batch_size in batch_sizes:
+        for _ in range(repeat):
+            random.seed(seed)
+            rng = np.random.default_rng(seed)
+            start = time.perf_counter()
+            if batch_size == 1:
+                for _ in range(rollouts):
+                    stimulate(board)
+            else:
+                for _ in range(rollouts // batch_size):
+                    stimulate_batch([board], batch_size, rng)
+            elapsed = time.perf_counter() - start
+            results[batch_size] = max(results.get(batch_size, 0), rollouts // batch_size * batch_size / elapsed)
+    return results
+
+
+def benchmark_parallel(workers=(1, 2, 4, 8), plies=(0, 20, 40), max_nodes=4000, seed=1, mode="root"):
+    """
+    Measures parallel_search nodes per second over a fixed position set for several worker counts
+    :param workers: Numbers of workers
+    :param plies: Number of random plies of each benchmark position
+    :param max_nodes: Nodes searched per position
+    :param seed: Seed of the positions and the rollouts
+    :param mode: The parallel_search mode
+    :return: A dict of nodes per second keyed by number of workers
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from ParallelSearch import parallel_search
+
+    boards = [random_position(seed, p) for p in plies]
+    results = {}
+    for n in workers:
+        with ProcessPoolExecutor(n) as pool:
+            # Start the worker processes before timing
+            list(pool.map(abs, range(n)))
+            random.seed(seed)
+            start = time.perf_counter()
+            for board in boards:
+                parallel_search(MCTSNode(board), timeout=float('inf'), max_nodes=max_nodes, workers=n, mode=mode,
+                                executor=pool)
+            results[n] = len(boards) * max_nodes / (time.perf_counter() - start)
+    return results
+
+
+def random_positions(count, seed=1):
+    """
+    Collects every position of random games
+    :param count: Number of positions
+    :param seed: Seed of the random games
+    :return: A list of count boards
+    """
+    rng = random.Random(seed)
+    boards = []
+    while len(boards) < count:
+        board = Board()
+        while not board.is_game_over() and len(boards) < count:
+            moves = board.get_moves()
+            board.move(moves[rng.randrange(len(moves))])
+            boards.append(Board(board))
+    return boards
+
+
+def benchmark_encoding(batch_sizes=(1, 16, 256), positions=1024, seed=1, repeat=3):
+    """
+    Measures boards_to_numpy encodings per second for several batch sizes
+    :param batch_sizes: Number of boards encoded per call
+    :param positions: Number of boards encoded per run
+    :param seed: Seed of the random positions
+    :param repeat: Number of runs per batch size, the fastest one is reported
+    :return: A dict of encodings per second keyed by batch size
+    """
+    boards = random_positions(positions, seed)
+    results = {}
+    for batch_size in batch_sizes:
+        out = np.empty((batch_size,) + Board.tensor_shape, dtype=np.int8)
+        batches = [boards[i:i + batch_size] for i in range(0, positions - batch_size + 1, batch_size)]
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for batch in batches:
+                boards_to_numpy(batch, out)
+            elapsed = time.perf_counter() - start
+            results[batch_size] = max(results.get(batch_size, 0), len(batches) * batch_size / elapsed)
+    return results
+
+
+def benchmark_nn_search(nn, batch_sizes=(1, 8, 16, 32, 64), max_nodes=512, seed=1):
+    """
+    Measures nn_search nodes per second for several leaf batch sizes
+    :param nn: The neural network for evaluation
+    :param batch_sizes: Number of leaves evaluated per call to the neural network
+    :param max_nodes: Nodes searched per batch size
+    :param seed: Seed of the search position
+    :return: A dict of nodes per second keyed by batch size
+    """
+    from NNSearch import nn_search
+
+    board = random_position(seed, 10)
+    results = {}
+    for batch_size in batch_sizes:
+        start = time.perf_counter()
+        root = nn_search(MCTSNode(board), nn, timeout=float('inf'), max_nodes=max_nodes, batch_size=batch_size)
+        results[batch_size] = root.visits / (time.perf_counter() - start)
+    return results
+
+
+def run_benchmarks(perft_depth=5):
+    """
+    Runs the CPU benchmarks
+    :param perft_depth: Depth of the perft runs
+    :return: A dict of results that can be written as JSON
+    """
+    from Perft import run_perft
+
+    return {"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "perft": run_perft(perft_depth),
+            "rollouts_per_second": benchmark_rollouts(),
+            "encodings_per_second": benchmark_encoding(),
+            "mcts_iterations_per_second": benchmark_mcts()}
+
+
+if __name__ == '__main__':
+    results = run_benchmarks()
+    for r in results["perft"]:
+        print("Position:{name} Depth:{depth} Nodes:{nodes} NPS:{nps:0.2f}".format(**r))
+    for batch_size, rps in results["rollouts_per_second"].items():
+        print("Batch:{} Rollouts/s:{:0.2f}".format(batch_size, rps))
+    for batch_size, eps in results["encodings_per_second"].items():
+        print("Batch:{} Encodings/s:{:0.2f}".format(batch_size, eps))
+    for p, ips in results["mcts_iterations_per_second"].items():
+        print("Plies:{} Iterations/s:{:0.2f}".format(p, ips))
+    # Optional output file to track the results across versions
+    if len(sys.argv) > 1:
+        with open(sys.argv[1], 'w') as f:
+            json.dump(results, f, indent=2)
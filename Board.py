@@ -1,12 +1,15 @@
 import numpy as np
 import random as rand
 
+from LookupTables import WON, FULL, MOVES, DECIDED, BIT_INDEX, ZOBRIST_PIECE, ZOBRIST_ACTIVE, ZOBRIST_SIDE
+
 
 class Board:
     """
     Representation of a Ultimate Tic Tac Toe board game
     """
     board_mask = 0b111111111
+    tensor_shape = (6, 9, 9)
 
     def __init__(self, other=None):
         """
@@ -20,6 +23,9 @@ class Board:
             self.global_black = other.global_black
             self.active_block = other.active_block[:]
             self.move_list = other.move_list[:]
+            self.decided = other.decided
+            self.result = other.result
+            self.hash = other.hash
         else:
             self.white = [0] * 9
             self.black = [0] * 9
@@ -27,6 +33,12 @@ class Board:
             self.global_black = 0
             self.active_block = [-1]
             self.move_list = []
+            # Mask of blocks that are won by either side or full
+            self.decided = 0
+            # Game result once the game is over, None while it is still in progress
+            self.result = None
+            # 64-bit Zobrist hash of the pieces, the active block and the side to move
+            self.hash = ZOBRIST_ACTIVE[0]
 
     def to_numpy(self):
         """
@@ -39,30 +51,7 @@ class Board:
         Layer 5: Drawn Global BitBoard
         :return: A (6, 9, 9) numpy array
         """
-        result = np.zeros((6, 9, 9), dtype=np.int8)
-        for i in range(81):
-            global_row = i // 9
-            global_col = i % 9
-            active_row = global_row // 3
-            active_col = global_col // 3
-            active_block = active_col + active_row * 3
-            local_row = global_row - active_row * 3
-            local_col = global_col - active_col * 3
-            local_index = local_col + local_row * 3
-            n = 1 << local_index
-            if (self.white[active_block] & n) != 0:
-                result[0, global_row, global_col] = 1
-            if (self.black[active_block] & n) != 0:
-                result[1, global_row, global_col] = 1
-            if self.active_block[self.plies()] == active_block or self.active_block[self.plies()] == -1:
-                result[2, global_row, global_col] = 1
-            if self.global_white == (1 << active_block):
-                result[3, global_row, global_col] = 1
-            if self.global_black == (1 << active_block):
-                result[4, global_row, global_col] = 1
-            if Board.board_mask == (self.white[active_block] | self.black[active_block]):
-                result[5, global_row, global_col] = 1
-        return result
+        return boards_to_numpy([self])[0]
 
     def __eq__(self, other):
         return type(other) is Board and \
@@ -106,9 +95,7 @@ class Board:
         return template.format(*pieces)
 
     def get_game_result(self):
-        if not self.is_game_over():
-            return
-        return 1 if is_won(self.global_white) else -1 if is_won(self.global_black) else 0
+        return self.result
 
     def get_moves(self):
         """
@@ -117,72 +104,97 @@ class Board:
         m[1] : 3x3 BitBoard of the move in the active block
         :return: A list of tuple of moves
         """
+        active = self.active_block[-1]
+        if active != -1:
+            return list(MOVES[active][self.white[active] | self.black[active]])
         result = []
-        active = self.active_block[self.plies()]
-        if active == -1:
-            for i in range(9):
-                n = 1 << i
-                if n & (self.global_white | self.global_black) != 0 or \
-                        Board.board_mask ^ (self.white[i] | self.black[i]) == 0:
-                    continue
-                empty = Board.board_mask & ~(self.white[i] | self.black[i])
-                while empty != 0:
-                    lsb = empty & -empty
-                    result.append((i, lsb))
-                    empty ^= lsb
-        else:
-            empty = Board.board_mask & ~(self.white[active] | self.black[active])
-            while empty != 0:
-                lsb = empty & -empty
-                result.append((active, lsb))
-                empty ^= lsb
+        for i in range(9):
+            if not (self.decided >> i) & 1:
+                result.extend(MOVES[i][self.white[i] | self.black[i]])
         return result
 
     def move(self, m):
-        active = m[1].bit_length() - 1
-        if self.is_white_to_move():
-            self.white[m[0]] ^= m[1]
-            if is_won(self.white[m[0]]):
-                self.global_white ^= 1 << m[0]
+        block, n = m
+        active = BIT_INDEX[n]
+        bit = 1 << block
+        won = False
+        if not len(self.move_list) & 1:  # white to move
+            self.hash ^= ZOBRIST_PIECE[0][block][n]
+            self.white[block] ^= n
+            if WON[self.white[block]]:
+                self.global_white ^= bit
+                self.decided |= bit
+                won = WON[self.global_white]
         else:
-            self.black[m[0]] ^= m[1]
-            if is_won(self.black[m[0]]):
-                self.global_black ^= 1 << m[0]
+            self.hash ^= ZOBRIST_PIECE[1][block][n]
+            self.black[block] ^= n
+            if WON[self.black[block]]:
+                self.global_black ^= bit
+                self.decided |= bit
+                won = WON[self.global_black]
+        if FULL[self.white[block] | self.black[block]]:
+            self.decided |= bit
 
-        if m[1] & (self.global_white | self.global_black) != 0 or \
-                Board.board_mask ^ (self.white[active] | self.black[active]) == 0:
+        if (self.decided >> active) & 1:
             active = -1
+        self.hash ^= ZOBRIST_ACTIVE[self.active_block[-1] + 1] ^ ZOBRIST_ACTIVE[active + 1] ^ ZOBRIST_SIDE
         self.move_list.append(m)
         self.active_block.append(active)
+        if won:
+            self.result = 1 if len(self.move_list) & 1 else -1
+        elif (active == -1 and self.decided == Board.board_mask) or len(self.move_list) == 80:
+            self.result = 0
 
     def un_move(self):
-        m = self.move_list.pop()
+        block, n = self.move_list.pop()
+        active = self.active_block.pop()
+        self.hash ^= ZOBRIST_ACTIVE[active + 1] ^ ZOBRIST_ACTIVE[self.active_block[-1] + 1] ^ ZOBRIST_SIDE
         if self.is_white_to_move():
-            if is_won(self.white[m[0]]):
-                self.global_white ^= 1 << m[0]
-            self.white[m[0]] ^= m[1]
+            self.hash ^= ZOBRIST_PIECE[0][block][n]
+            if WON[self.white[block]]:
+                self.global_white ^= 1 << block
+            self.white[block] ^= n
         else:
-            if is_won(self.black[m[0]]):
-                self.global_black ^= 1 << m[0]
-            self.black[m[0]] ^= m[1]
-        self.active_block.pop()
+            self.hash ^= ZOBRIST_PIECE[1][block][n]
+            if WON[self.black[block]]:
+                self.global_black ^= 1 << block
+            self.black[block] ^= n
+        if not DECIDED[(self.white[block] << 9) | self.black[block]]:
+            self.decided &= ~(1 << block)
+        self.update_result()
+
+    def update_result(self):
+        """
+        Updates the cached game result from the global BitBoards
+        """
+        if WON[self.global_white]:
+            self.result = 1
+        elif WON[self.global_black]:
+            self.result = -1
+        elif not self.has_moves() or self.plies() == 80:
+            self.result = 0
+        else:
+            self.result = None
 
     def plies(self):
         return len(self.move_list)
 
+    def has_moves(self):
+        """
+        Checks whether any legal move exists without generating the move list
+        :return: True if there is at least one empty cell in a playable block
+        """
+        return self.active_block[-1] != -1 or self.decided != Board.board_mask
+
     def is_game_over(self):
-        return is_won(self.global_white) or is_won(self.global_black) or len(
-            self.get_moves()) == 0 or self.plies() == 80
+        return self.result is not None
 
     def is_white_to_move(self):
         return self.plies() % 2 == 0
 
 
 def is_won(board):
-    row = (((((board & 0b1001001) << 1) & board) << 1) & board) != 0
-    col = (((((board & 0b111) << 3) & board) << 3) & board) != 0
-    diag = (board & 0b100010001) == 0b100010001 or (board & 0b1010100) == 0b1010100
-    return row or col or diag
+    return WON[board]
 
 
 def moves_to_numpy(moves):
@@ -191,11 +203,45 @@ def moves_to_numpy(moves):
     :param moves: A list of moves
     :return: A (9, 9) numpy array
     """
-    result = np.zeros((9, 9), dtype=np.int8)
-    for m in moves:
-        global_row, global_col = move_to_index(m)
-        result[global_row, global_col] = 1
-    return result
+    result = np.zeros(81, dtype=np.int8)
+    result[[FLAT_INDEX[m] for m in moves]] = 1
+    return result.reshape((9, 9))
+
+
+def moves_list_to_numpy(moves_list, out=None):
+    """
+    Converts lists of moves into a batch of 9x9 BitBoards, see moves_to_numpy
+    :param moves_list: A list of lists of moves
+    :param out: Optional preallocated C-contiguous (N, 9, 9) int8 array to fill
+    :return: A (N, 9, 9) numpy array
+    """
+    n = len(moves_list)
+    if out is None:
+        out = np.empty((n, 9, 9), dtype=np.int8)
+    flat = out.reshape((n, 81))
+    flat[:] = 0
+    rows = [i for i, moves in enumerate(moves_list) for _ in moves]
+    cols = [FLAT_INDEX[m] for moves in moves_list for m in moves]
+    flat[rows, cols] = 1
+    return out
+
+
+def boards_to_numpy(boards, out=None):
+    """
+    Converts a list of boards into a batch of tensors in one pass, see Board.to_numpy
+    :param boards: A list of boards
+    :param out: Optional preallocated C-contiguous (N, 6, 9, 9) int8 array to fill
+    :return: A (N, 6, 9, 9) numpy array
+    """
+    n = len(boards)
+    if out is None:
+        out = np.empty((n,) + Board.tensor_shape, dtype=np.int8)
+    words = np.array([b.white + b.black + [ACTIVE_MASKS[b.active_block[-1] + 1], b.global_white, b.global_black]
+                      for b in boards], dtype=np.int32).reshape((n, 21))
+    flat = out.reshape((n, 6 * 81))
+    flat[:, :5 * 81] = (words[:, PLANE_WORDS] >> PLANE_SHIFTS) & 1
+    flat[:, 5 * 81:] = ((words[:, 0:9] | words[:, 9:18]) == Board.board_mask)[:, BLOCK_OF_CELL]
+    return out
 
 
 def move_to_index(m):
@@ -221,6 +267,34 @@ def index_to_move(global_row, global_col):
     return active_block, n
 
 
+# FLAT_MOVES[row * 9 + col]: move tuple of a cell of the 9x9 grid
+FLAT_MOVES = tuple(index_to_move(i // 9, i % 9) for i in range(81))
+FLAT_INDEX = {m: i for i, m in enumerate(FLAT_MOVES)}
+
+# BLOCK_OF_CELL[i] and LOCAL_OF_CELL[i]: block index and local bit index of the flat cell i
+BLOCK_OF_CELL = np.array([(i // 27) * 3 + (i % 9) // 3 for i in range(81)])
+LOCAL_OF_CELL = np.array([((i // 9) % 3) * 3 + i % 3 for i in range(81)])
+# ACTIVE_MASKS[active + 1]: mask of the blocks a move can be played in
+ACTIVE_MASKS = [Board.board_mask] + [1 << i for i in range(9)]
+# Layers 0-4 of Board.to_numpy are bit PLANE_SHIFTS of the board word PLANE_WORDS, where the words are
+# white[0:9], black[0:9], the active block mask, global_white and global_black
+PLANE_WORDS = np.concatenate([BLOCK_OF_CELL, BLOCK_OF_CELL + 9, np.full(3 * 81, 18) + np.repeat(np.arange(3), 81)])
+PLANE_SHIFTS = np.concatenate([LOCAL_OF_CELL, LOCAL_OF_CELL, np.tile(BLOCK_OF_CELL, 3)])
+
+
+def move_to_flat_index(m):
+    """
+    Converts a move to the flat index (0-80) of its cell in the 9x9 grid
+    :param m: A move in tuple form
+    :return: row * 9 + col of the move
+    """
+    return FLAT_INDEX[m]
+
+
+def flat_index_to_move(i):
+    return FLAT_MOVES[i]
+
+
 if __name__ == '__main__':
     b = Board()
     print(all([index_to_move(*move_to_index(m)) == m for m in b.get_moves()]))
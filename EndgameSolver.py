@@ -0,0 +1,282 @@
+"""
+Depth-first proof-number search (df-pn) solving late positions exactly.
+A position is solved with two binary searches for the side to move: whether it wins, and when it does not,
+whether it at least draws. The game graph has no cycles, so proof and disproof numbers stored by Board.hash
+are shared between transpositions without further care.
+"""
+import random
+import time
+
+from Board import Board
+from LookupTables import EMPTY_CELLS
+from MCTNode import MCTSNode, RESULT_STATES, get_last_move
+from AlphaBetaSearch import SearchTimeout
+from TranspositionTable import TranspositionTable
+
+INF = 1 << 30
+
+
+def empty_cells(board: Board):
+    """
+    :param board: The board
+    :return: The number of empty cells in blocks still in play
+    """
+    count = 0
+    for i in range(9):
+        if not (board.decided >> i) & 1:
+            count += len(EMPTY_CELLS[board.white[i] | board.black[i]])
+    return count
+
+
+class EndgameSolver:
+    """
+    df-pn solver the searches hand positions with few empty cells off to
+    """
+
+    def __init__(self, threshold=20, max_nodes=20000, leaf_nodes=1000, timeout=float('inf'), capacity=1 << 18):
+        """
+        :param threshold: Max number of empty cells of the positions solved
+        :param max_nodes: Max nodes searched per solve of a root, the position stays unsolved when exceeded
+        :param leaf_nodes: Max nodes searched per solve of a leaf, searches meet many leaves that are hard to solve
+        :param timeout: Timeout duration per solve in seconds
+        :param capacity: Max number of entries of each of the transposition tables
+        """
+        self.threshold = threshold
+        self.max_nodes = max_nodes
+        self.leaf_nodes = leaf_nodes
+        self.timeout = timeout
+        # (phi, delta, best move) entries by Board.hash, one table for each side and goal
+        self.tables = {(side, draw_wins): TranspositionTable(capacity)
+                       for side in (1, -1) for draw_wins in (False, True)}
+        self.tt = None
+        self.attacker = 1
+        self.draw_wins = False
+        self.nodes = 0
+        self.budget = 0
+        self.deadline = float('inf')
+        self.solved = 0
+        self.unsolved = 0
+
+    def is_endgame(self, board: Board):
+        return not board.is_game_over() and empty_cells(board) <= self.threshold
+
+    def solve(self, board: Board, max_nodes=None):
+        """
+        Solves a position within the node and time budget
+        :param board: The board to solve
+        :param max_nodes: Max nodes searched, max_nodes of the solver when None
+        :return: A tuple of the result from white's perspective and a best move, (None, None) when unsolved
+        """
+        if board.is_game_over():
+            return board.get_game_result(), None
+        board = Board(board)
+        side = 1 if board.is_white_to_move() else -1
+        self.budget = self.nodes + (self.max_nodes if max_nodes is None else max_nodes)
+        self.deadline = time.time() + self.timeout
+        try:
+            won, move = self.prove(board, side, False)
+            if won:
+                result = side
+            else:
+                drawn, draw_move = self.prove(board, side, True)
+                result = 0 if drawn else -side
+                # Every move loses when the draw is disproven, the search still picks the hardest one to refute
+                move = draw_move if drawn else move
+        except SearchTimeout:
+            self.unsolved += 1
+            return None, None
+        self.solved += 1
+        if move is None:
+            move = board.get_moves()[0]
+        return result, move
+
+    def prove(self, board: Board, attacker, draw_wins):
+        """
+        :param board: The board to search, restored after the search
+        :param attacker: The side proving the goal, 1 for white and -1 for black
+        :param draw_wins: Whether a draw achieves the goal of the attacker
+        :return: A tuple of whether the goal is proven and the best move of the side to move
+        """
+        self.tt = self.tables[(attacker, draw_wins)]
+        self.attacker = attacker
+        self.draw_wins = draw_wins
+        phi, delta, move = self.mid(board, INF, INF)
+        # The side to move is the attacker at the root, phi is its proof number
+        return phi == 0, move
+
+    def terminal_value(self, board: Board):
+        result = board.get_game_result()
+        success = result == self.attacker or (self.draw_wins and result == 0)
+        attacker_to_move = (1 if board.is_white_to_move() else -1) == self.attacker
+        return (0, INF) if success == attacker_to_move else (INF, 0)
+
+    def mid(self, board: Board, phi_threshold, delta_threshold):
+        """
+        Expands a node until its phi or delta reaches its threshold
+        phi is the proof number at nodes of the attacker and the disproof number at nodes of the defender,
+        delta the other one, so phi = min(child delta) and delta = sum(child phi) at every node
+        :return: A tuple of phi, delta and the move of the child with the smallest delta
+        """
+        self.nodes += 1
+        if self.nodes > self.budget or (not self.nodes & 1023 and time.time() > self.deadline):
+            raise SearchTimeout()
+        entry = self.tt.probe(board.hash)
+        if entry is not None and (entry[0] >= phi_threshold or entry[1] >= delta_threshold):
+            return entry
+
+        moves = board.get_moves()
+        phis = []
+        deltas = []
+        for m in moves:
+            board.move(m)
+            if board.is_game_over():
+                phi, delta = self.terminal_value(board)
+            else:
+                child = self.tt.probe(board.hash)
+                phi, delta = (1, 1) if child is None else child[:2]
+            board.un_move()
+            phis.append(phi)
+            deltas.append(delta)
+
+        while True:
+            best = 0
+            second_delta = INF
+            for i in range(1, len(moves)):
+                if deltas[i] < deltas[best]:
+                    second_delta = deltas[best]
+                    best = i
+                elif deltas[i] < second_delta:
+                    second_delta = deltas[i]
+            phi = deltas[best]
+            delta = min(sum(phis), INF)
+            if phi >= phi_threshold or delta >= delta_threshold:
+                break
+            child_phi_threshold = min(delta_threshold - delta + phis[best], INF)
+            child_delta_threshold = min(phi_threshold, second_delta + 1)
+            board.move(moves[best])
+            try:
+                phis[best], deltas[best], _ = self.mid(board, child_phi_threshold, child_delta_threshold)
+            finally:
+                board.un_move()
+        entry = (phi, delta, moves[best])
+        self.tt.store(board.hash, entry)
+        return entry
+
+    def prove_node(self, node: MCTSNode):
+        """
+        Solves the position of a leaf in the endgame and marks the leaf as proven, updating its ancestors
+        :param node: The MCTSNode, with its board attached
+        :return: The result from white's perspective or None when the leaf is not in the endgame or unsolved
+        """
+        if not self.is_endgame(node.board):
+            return None
+        result, _ = self.solve(node.board, self.leaf_nodes)
+        if result is None:
+            return None
+        node.tree.set_state(node.index, RESULT_STATES[result])
+        node.tree.update_proven(node.index, node.is_white_to_move())
+        return result
+
+    def prove_children(self, node: MCTSNode):
+        """
+        Solves a root in the endgame and proves the children the choice of the move depends on,
+        the winning move of a won root or every child of a drawn or lost one
+        :param node: The MCTSNode, with its board attached
+        :return: Whether the node is proven
+        """
+        # Leaves proven by prove_node have no children yet
+        if node.is_terminal_node() and not node.is_leaf():
+            return True
+        if not self.is_endgame(node.board):
+            return node.is_terminal_node()
+        result, move = self.solve(node.board)
+        if result is None:
+            return False
+        if node.is_leaf():
+            node.expand()
+        board = node.board
+        for child in node.children:
+            if child.is_terminal_node():
+                continue
+            child_move = get_last_move(child)
+            if result == (1 if node.is_white_to_move() else -1):
+                if child_move != move:
+                    continue
+                child_result = result
+            else:
+                b = Board(board)
+                b.move(child_move)
+                child_result, _ = self.solve(b)
+                if child_result is None:
+                    continue
+            node.tree.set_state(child.index, RESULT_STATES[child_result])
+            node.tree.update_proven(child.index, child.is_white_to_move())
+        return node.is_terminal_node()
+
+    def stats(self):
+        return {"solved": self.solved,
+                "unsolved": self.unsolved,
+                "nodes": self.nodes,
+                "entries": sum(len(tt) for tt in self.tables.values())}
+
+    def __str__(self):
+        return "Solver Solved:{solved} Unsolved:{unsolved} Nodes:{nodes} Entries:{entries}".format(**self.stats())
+
+
+def check_training_labels(positions=30, max_nodes=200, seed=0):
+    """
+    Checks that the value labels of solver proven roots are given for the side to move like those of unproven ones,
+    on random black to move endgames with a decisive result. Unproven labels are noisy estimates, the labels of a
+    search without solver only have to agree in sign with the proven ones on most positions.
+    :param positions: Number of positions whose unproven root stays open
+    :param max_nodes: Nodes of the searches without solver, few enough to leave many roots open
+    :param seed: Seed of the random positions and searches
+    :return: A tuple of the share of agreeing signs and the number of proven labels not matching the solved result
+    """
+    from MCTSearch import mst_search
+
+    random.seed(seed)
+    solver = EndgameSolver(max_nodes=1e6)
+    agreeing = 0
+    compared = 0
+    mismatches = 0
+    while compared < positions:
+        b = Board()
+        while not b.is_game_over() and (empty_cells(b) > solver.threshold or b.is_white_to_move()):
+            moves = b.get_moves()
+            b.move(moves[random.randrange(len(moves))])
+        result = None if b.is_game_over() else solver.solve(b)[0]
+        if not result:
+            continue
+        proven = MCTSNode(b)
+        solver.prove_children(proven)
+        proven_value = proven.to_numpy_training_data()[2]
+        # Black to move, a white win is a loss for the side to move
+        mismatches += proven_value != -result
+        unproven = mst_search(MCTSNode(b), timeout=float('inf'), max_nodes=max_nodes)
+        if unproven.is_terminal_node():
+            continue
+        compared += 1
+        agreeing += proven_value * unproven.to_numpy_training_data()[2] > 0
+    return agreeing / compared, mismatches
+
+
+if __name__ == '__main__':
+    agreement, mismatches = check_training_labels()
+    print("Training labels Agreement:{:0.2f} Mismatches:{}".format(agreement, mismatches),
+          "OK" if agreement > 0.5 and mismatches == 0 else "FAILED")
+    random.seed(0)
+    solver = EndgameSolver(max_nodes=1e6)
+    for game in range(5):
+        b = Board()
+        while not b.is_game_over() and empty_cells(b) > solver.threshold:
+            moves = b.get_moves()
+            b.move(moves[random.randrange(len(moves))])
+        if b.is_game_over():
+            continue
+        start = time.time()
+        nodes = solver.nodes
+        result, move = solver.solve(b)
+        print("Empty:{} Result:{} Move:{} Nodes:{} Time:{:0.3f}".format(empty_cells(b), result, move,
+                                                                         solver.nodes - nodes, time.time() - start))
+    print(solver)
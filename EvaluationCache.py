@@ -0,0 +1,125 @@
+import time
+import numpy as np
+
+from Board import boards_to_numpy
+from SearchStats import phase_timer
+from TranspositionTable import TranspositionTable
+from Utils import generate_symmetries, apply_symmetry, invert_symmetry
+
+
+def canonical_key(x):
+    """
+    Finds the canonical form of an encoded board among its 8 symmetries
+    :param x: A (6, 9, 9) encoded board
+    :return: A tuple of (bytes of the canonical board, index of the symmetry mapping x onto it)
+    """
+    keys = [s.tobytes() for s in generate_symmetries(x, axes=(1, 2))]
+    index = min(range(len(keys)), key=keys.__getitem__)
+    return keys[index], index
+
+
+class EvaluationCache:
+    """
+    LRU cache of neural network evaluations in front of a NeuralNetwork, providing the same predict interface.
+    Without symmetries positions are keyed by Board.hash, with symmetries every position is keyed by
+    its canonical encoding and the cached policy is transformed back onto the queried position.
+    """
+
+    def __init__(self, nn, capacity=1 << 16, symmetries=False):
+        """
+        :param nn: The NeuralNetwork evaluating positions missing from the cache
+        :param capacity: Max number of cached evaluations
+        :param symmetries: Share evaluations between the 8 symmetries of a position
+        """
+        self.nn = nn
+        self.symmetries = symmetries
+        self.table = TranspositionTable(capacity)
+        self.evaluated = 0
+        self.inference_time = 0.0
+
+    def predict(self, board):
+        return self.predict_batch([board])
+
+    def predict_batch(self, boards, stats=None):
+        """
+        Evaluates a list of boards, only passing the boards missing from the cache to the neural network
+        :param boards: A list of boards
+        :param stats: Optional SearchStats timing the encoding and the inference, the time of the cache lookups
+                      is left to the other time of the search
+        :return: The policy (N, 9, 9) and value (N, 1) outputs
+        """
+        if self.symmetries:
+            with phase_timer(stats, "encoding"):
+                x = boards_to_numpy(boards)
+            return self.predict_numpy(x, stats)
+        return self.lookup([b.hash for b in boards], [0] * len(boards),
+                           lambda missing: boards_to_numpy([boards[i] for i in missing]), stats)
+
+    def predict_numpy(self, x, stats=None):
+        """
+        Evaluates a batch of encoded boards, keyed by their encoding
+        :param x: A (N, 6, 9, 9) numpy array of encoded boards
+        :param stats: Optional SearchStats timing the inference
+        :return: The policy (N, 9, 9) and value (N, 1) outputs
+        """
+        if self.symmetries:
+            keys, transforms = zip(*[canonical_key(a) for a in x])
+        else:
+            keys, transforms = [a.tobytes() for a in x], [0] * len(x)
+        return self.lookup(keys, transforms, lambda missing: x[missing], stats)
+
+    def lookup(self, keys, transforms, encode, stats=None):
+        """
+        :param keys: Cache key of every position
+        :param transforms: Index of the symmetry mapping every position onto its cached form
+        :param encode: Function returning the encoded boards of a list of missing position indices
+        :param stats: Optional SearchStats timing the encoding and the inference of the missing positions
+        :return: The policy (N, 9, 9) and value (N, 1) outputs
+        """
+        n = len(keys)
+        p = np.empty((n, 9, 9), dtype=np.float32)
+        v = np.empty((n, 1), dtype=np.float32)
+        missing = []
+        for i, key in enumerate(keys):
+            entry = self.table.probe(key)
+            if entry is None:
+                missing.append(i)
+            else:
+                p[i] = invert_symmetry(entry[0], transforms[i])
+                v[i] = entry[1]
+        if len(missing) > 0:
+            with phase_timer(stats, "encoding"):
+                x = encode(missing)
+            start = time.perf_counter()
+            with phase_timer(stats, "inference"):
+                missing_p, missing_v = self.nn.predict_numpy(x)
+            self.inference_time += time.perf_counter() - start
+            self.evaluated += len(missing)
+            for k, i in enumerate(missing):
+                p[i] = missing_p[k]
+                v[i] = missing_v[k]
+                self.table.store(keys[i], (apply_symmetry(p[i], transforms[i]).copy(), float(v[i, 0])))
+        return p, v
+
+    def clear(self):
+        self.table.clear()
+
+    def hit_rate(self):
+        return self.table.hit_rate()
+
+    def saved_time(self):
+        """
+        :return: Estimated seconds of inference saved, hits times the mean inference time per position
+        """
+        return self.table.hits * self.inference_time / self.evaluated if self.evaluated > 0 else 0.0
+
+    def stats(self):
+        stats = self.table.stats()
+        stats.update({"evaluated": self.evaluated,
+                      "inference_time": self.inference_time,
+                      "saved_time": self.saved_time()})
+        return stats
+
+    def __str__(self):
+        return "Cache Entries:{entries} Hits:{hits} Misses:{misses} HitRate:{hit_rate:0.2%} " \
+               "Evictions:{evictions} Saved:{saved_time:0.2f}s".format(**self.stats())
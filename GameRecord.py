@@ -0,0 +1,172 @@
+"""
+Compact binary game records.
+A record file starts with the magic b"UTTR" and a version byte, followed by one record per game:
+    uint8   number of moves n
+    int8    result from white's perspective, -128 for an unfinished game
+    uint8   flags, bit 0 set when search data follows the moves
+    n bytes flat move indices (0-80), see move_to_flat_index
+and when search data is present, for every move:
+    int16   root value scaled by 32767
+    uint8   number k of moves with visits
+    k bytes flat move indices
+    k uint16 visit distribution quantized to 65535
+"""
+import struct
+import numpy as np
+
+from Board import Board, boards_to_numpy, move_to_flat_index, flat_index_to_move
+
+MAGIC = b"UTTR"
+VERSION = 1
+HAS_SEARCH_DATA = 1
+NO_RESULT = -128
+HEADER = struct.Struct("<BbB")
+VALUE_SCALE = 32767
+WEIGHT_SCALE = 65535
+
+
+class GameRecord:
+    """
+    A decoded game
+    moves    : (n,) uint8 flat move indices
+    result   : the result from white's perspective or None
+    policies : (n, 9, 9) float32 root visit distributions, None without search data
+    values   : (n,) float32 root values, None without search data
+    """
+    __slots__ = ('moves', 'result', 'policies', 'values')
+
+    def __init__(self, moves, result, policies=None, values=None):
+        self.moves = moves
+        self.result = result
+        self.policies = policies
+        self.values = values
+
+    def get_moves(self):
+        return [flat_index_to_move(i) for i in self.moves]
+
+
+def encode_record(moves, result, policies=None, values=None):
+    """
+    :param moves: A list of moves in tuple form
+    :param result: The game result from white's perspective, None for an unfinished game
+    :param policies: Optional (9, 9) visit distribution of the search at every move
+    :param values: Optional root value of the search at every move
+    :return: The record as bytes
+    """
+    flags = 0 if policies is None else HAS_SEARCH_DATA
+    data = [HEADER.pack(len(moves), NO_RESULT if result is None else result, flags),
+            bytes(move_to_flat_index(m) for m in moves)]
+    if flags & HAS_SEARCH_DATA:
+        for p, v in zip(policies, values):
+            p = np.reshape(p, 81)
+            indices = np.flatnonzero(p > 0).astype(np.uint8)
+            weights = np.round(p[indices] / np.sum(p) * WEIGHT_SCALE).astype('<u2')
+            data.append(struct.pack("<hB", int(round(float(v) * VALUE_SCALE)), len(indices)))
+            data.append(indices.tobytes())
+            data.append(weights.tobytes())
+    return b"".join(data)
+
+
+def decode_records(data):
+    """
+    Decodes the records of a record file
+    :param data: The content of the file
+    :return: A generator of GameRecord
+    """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a game record file")
+    if data[len(MAGIC)] != VERSION:
+        raise ValueError("Unsupported game record version {}".format(data[len(MAGIC)]))
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    offset = len(MAGIC) + 1
+    while offset < len(data):
+        n, result, flags = HEADER.unpack_from(data, offset)
+        offset += HEADER.size
+        moves = buffer[offset:offset + n]
+        offset += n
+        policies = None
+        values = None
+        if flags & HAS_SEARCH_DATA:
+            policies = np.zeros((n, 81), dtype=np.float32)
+            values = np.empty(n, dtype=np.float32)
+            for i in range(n):
+                value, k = struct.unpack_from("<hB", data, offset)
+                offset += 3
+                indices = buffer[offset:offset + k]
+                offset += k
+                weights = np.frombuffer(data, dtype='<u2', count=k, offset=offset)
+                offset += 2 * k
+                policies[i, indices] = weights / np.sum(weights, dtype=np.float32)
+                values[i] = value / VALUE_SCALE
+            policies = policies.reshape((n, 9, 9))
+        yield GameRecord(moves, None if result == NO_RESULT else result, policies, values)
+
+
+def read_records(filename):
+    with open(filename, 'rb') as f:
+        return list(decode_records(f.read()))
+
+
+class GameRecordWriter:
+    """
+    Appends game records to a record file
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC + bytes([VERSION]))
+
+    def add_game(self, moves, result, samples=None):
+        """
+        :param moves: A list of moves in tuple form
+        :param result: The game result from white's perspective
+        :param samples: Optional to_numpy_training_data samples of every move, their policy and value are kept
+        """
+        policies = None if samples is None else [s[1] for s in samples]
+        values = None if samples is None else [s[2] for s in samples]
+        self.file.write(encode_record(moves, result, policies, values))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def replay_samples(records, value="search"):
+    """
+    Replays game records through Board to rebuild training samples in bulk
+    :param records: A list of GameRecord
+    :param value: "search" for the recorded root values as in to_numpy_training_data,
+                  "result" for the game result from the point of view of the side to move
+    :return: A tuple of the (N, 6, 9, 9) inputs, (N, 9, 9) policies or None and (N,) values of every move
+    """
+    boards = []
+    policies = []
+    values = []
+    for record in records:
+        if record.policies is None and value == "search":
+            raise ValueError("Record without search data")
+        board = Board()
+        for m in record.moves:
+            boards.append(Board(board))
+            if value == "result":
+                values.append(0 if record.result is None else record.result * (1 if board.is_white_to_move() else -1))
+            board.move(flat_index_to_move(m))
+        policies.append(record.policies)
+        if value == "search":
+            values.append(record.values)
+    if value == "search":
+        values = np.concatenate(values) if len(values) > 0 else np.zeros(0, dtype=np.float32)
+    else:
+        values = np.array(values, dtype=np.float32)
+    # Policies are only available when every record holds search data
+    if len(policies) == 0 or any(policy is None for policy in policies):
+        p = None
+    else:
+        p = np.concatenate(policies)
+    return boards_to_numpy(boards), p, values
@@ -0,0 +1,58 @@
+"""
+Precomputed lookup tables for 3x3 (9-bit) tic tac toe BitBoards.
+Every table is indexed by the 9-bit value of a local board, so the same
+tables serve both the 9 local boards and the global board of won blocks.
+"""
+from random import Random
+
+board_mask = 0b111111111
+board_count = 1 << 9
+
+
+def compute_is_won(board):
+    """
+    Bit-twiddling win test used to build the WON table
+    :param board: A 9-bit BitBoard
+    :return: True if the BitBoard contains a row, column or diagonal
+    """
+    row = (((((board & 0b1001001) << 1) & board) << 1) & board) != 0
+    col = (((((board & 0b111) << 3) & board) << 3) & board) != 0
+    diag = (board & 0b100010001) == 0b100010001 or (board & 0b1010100) == 0b1010100
+    return row or col or diag
+
+
+# WON[board]: board contains three in a row
+WON = tuple(compute_is_won(b) for b in range(board_count))
+
+# FULL[occupied]: every cell of the block is taken
+FULL = tuple(b == board_mask for b in range(board_count))
+
+# EMPTY_CELLS[occupied]: single bit masks of the empty cells, lowest bit first
+EMPTY_CELLS = tuple(tuple(1 << i for i in range(9) if not (b >> i) & 1) for b in range(board_count))
+
+# MOVES[block][occupied]: move tuples (block, bit) for every empty cell of a block
+MOVES = tuple(tuple(tuple((block, n) for n in EMPTY_CELLS[b]) for b in range(board_count)) for block in range(9))
+
+# DECIDED[(white << 9) | black]: block is won by either side or full
+DECIDED = bytes(WON[w] or WON[b] or FULL[w | b] for w in range(board_count) for b in range(board_count))
+
+# BIT_INDEX[bit]: index of a single bit mask, -1 for anything else
+BIT_INDEX = tuple({1 << i: i for i in range(9)}.get(n, -1) for n in range(board_count))
+
+
+def generate_zobrist_keys(seed=0x5eed):
+    """
+    Generates the random 64-bit keys used for Zobrist hashing
+    :param seed: Seed of the key generator, fixed so hashes are stable between runs
+    :return: A tuple of (piece keys, active block keys, side to move key)
+    """
+    rng = Random(seed)
+    # piece_keys[side][block][bit], only single bit indices are populated
+    piece_keys = tuple(tuple(tuple(rng.getrandbits(64) if BIT_INDEX[n] != -1 else 0 for n in range(board_count))
+                             for _ in range(9)) for _ in range(2))
+    # active_keys[active + 1] for the active block -1 to 8
+    active_keys = tuple(rng.getrandbits(64) for _ in range(10))
+    return piece_keys, active_keys, rng.getrandbits(64)
+
+
+ZOBRIST_PIECE, ZOBRIST_ACTIVE, ZOBRIST_SIDE = generate_zobrist_keys()
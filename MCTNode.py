@@ -1,29 +1,450 @@
 import math
 
 from Board import *
-from Trees import TreeNode
 from Utils import softmax
 
+# Node states stored in MCTSTree.state
+OPEN = 0
+WHITE_WON = 1
+BLACK_WON = 2
+DRAW = 3
+STATE_NAMES = ("OPEN", "WHITE_WON", "BLACK_WON", "DRAW")
+STATE_CODES = {name: code for code, name in enumerate(STATE_NAMES)}
+RESULT_STATES = {1: WHITE_WON, -1: BLACK_WON, 0: DRAW}
+STATE_RESULTS = {"WHITE_WON": 1, "BLACK_WON": -1, "DRAW": 0}
+# ALTERNATING_SIGNS[white_to_move]: sign of a white result for each node on a path up from a node
+ALTERNATING_SIGNS = (np.resize([1.0, -1.0], 128), np.resize([-1.0, 1.0], 128))
+# STATE_RANKS[white_to_move][state]: rank of a proven child from the point of view of its parent
+STATE_RANKS = (np.array([0, -3, 3, 0], dtype=np.float64), np.array([0, 3, -3, 0], dtype=np.float64))
 
-class MCTSNode(TreeNode):
 
-    def __init__(self, board: Board, parent=None, children=None, wins=0, visits=0, state="OPEN", c=2.0, policy=None):
-        super().__init__(parent=parent, children=children)
-        self.board = board
-        self.wins = wins
-        self.visits = visits
-        self.state = state
+class MCTSTree:
+    """
+    Struct-of-arrays storage of a Monte Carlo search tree
+    Node i is described by the i-th entry of every array, node 0 is the root.
+    The children of a node are stored contiguously in [first_child, first_child + child_count).
+    Boards are not stored per node, they are rebuilt by replaying moves from the root board.
+    """
+    chunk_size = 1 << 14
+    array_names = ('visits', 'wins', 'policy', 'parent', 'first_child', 'child_count', 'open_children', 'move',
+                   'state', 'c_log_visits', 'sqrt_c_visits')
+
+    def __init__(self, board: Board, c=2.0, capacity=chunk_size):
+        """
+        Initializes a tree holding only the root node
+        :param board: The board of the root node, copied
+        :param c: Exploration constant of the UCT formulas
+        :param capacity: Number of nodes preallocated
+        """
+        self.board = Board(board)
         self.c = c
-        self.policy = policy
+        self.size = 0
+        self.capacity = 0
+        self.visits = np.zeros(0, dtype=np.int32)
+        self.wins = np.zeros(0, dtype=np.float64)
+        self.policy = np.zeros(0, dtype=np.float32)
+        self.parent = np.zeros(0, dtype=np.int32)
+        self.first_child = np.zeros(0, dtype=np.int32)
+        self.child_count = np.zeros(0, dtype=np.int8)
+        # Number of children still in the OPEN state, a node is proven once it drops to 0
+        self.open_children = np.zeros(0, dtype=np.int8)
+        self.move = np.zeros(0, dtype=np.int8)
+        self.state = np.zeros(0, dtype=np.int8)
+        # Exploration terms of the node as a parent, c * log(visits) and sqrt(c * visits), updated on backpropagation
+        self.c_log_visits = np.zeros(0, dtype=np.float32)
+        self.sqrt_c_visits = np.zeros(0, dtype=np.float32)
+        self.grow(capacity)
+        root = self.allocate(1)
+        if self.board.is_game_over():
+            self.state[root] = RESULT_STATES[self.board.get_game_result()]
+
+    def arrays(self):
+        return [getattr(self, name) for name in MCTSTree.array_names]
+
+    def grow(self, capacity):
+        """
+        Grows the arrays in multiples of chunk_size to hold at least capacity nodes
+        :param capacity: The number of nodes needed
+        """
+        if capacity <= self.capacity:
+            return
+        capacity = -(-capacity // MCTSTree.chunk_size) * MCTSTree.chunk_size
+        for name in MCTSTree.array_names:
+            old = getattr(self, name)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.size] = old[:self.size]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def allocate(self, n):
+        """
+        Allocates n contiguous nodes with no parent, no children and no statistics
+        :param n: The number of nodes
+        :return: The index of the first node
+        """
+        start = self.size
+        self.grow(start + n)
+        self.size += n
+        self.parent[start:self.size] = -1
+        self.first_child[start:self.size] = -1
+        self.move[start:self.size] = -1
+        return start
+
+    def add_children(self, index, moves, states, policy=None):
+        """
+        Allocates the children of a leaf node
+        :param index: The index of the parent node
+        :param moves: Flat move indices (0-80) of the children
+        :param states: Node states of the children
+        :param policy: Optional prior probabilities of the children
+        :return: The index of the first child
+        """
+        start = self.allocate(len(moves))
+        end = self.size
+        self.parent[start:end] = index
+        self.move[start:end] = moves
+        self.state[start:end] = states
+        if policy is not None:
+            self.policy[start:end] = policy
+        self.first_child[index] = start
+        self.child_count[index] = len(moves)
+        self.open_children[index] = np.count_nonzero(self.state[start:end] == OPEN)
+        return start
+
+    def set_state(self, index, state):
+        """
+        Marks a node as proven, keeping the open children count of its parent up to date
+        :param index: The index of the node
+        :param state: The proven state of the node
+        """
+        if self.state[index] == OPEN and state != OPEN:
+            parent = self.parent[index]
+            if parent != -1:
+                self.open_children[parent] -= 1
+        self.state[index] = state
+
+    def get_proven_state(self, index, white_to_move):
+        """
+        Computes the minimax state of a node from the states of its children
+        :param index: The index of the node
+        :param white_to_move: Whether white is to move at the node
+        :return: The proven state or OPEN if the children do not decide the node yet
+        """
+        count = int(self.child_count[index])
+        if count == 0:
+            return OPEN
+        start = int(self.first_child[index])
+        states = self.state[start:start + count]
+        win, loss = (WHITE_WON, BLACK_WON) if white_to_move else (BLACK_WON, WHITE_WON)
+        if np.any(states == win):
+            return win
+        if self.open_children[index] > 0:
+            return OPEN
+        return DRAW if np.any(states == DRAW) else loss
+
+    def update_proven(self, index, white_to_move):
+        """
+        Marks a node and its ancestors as proven when their children decide them
+        :param index: The index of the node whose children changed
+        :param white_to_move: Whether white is to move at the node
+        """
+        if self.state[index] == OPEN:
+            state = self.get_proven_state(index, white_to_move)
+            if state == OPEN:
+                return
+            self.set_state(index, state)
+        state = self.state[index]
+        index = self.parent[index]
+        while index != -1 and self.state[index] == OPEN:
+            white_to_move = not white_to_move
+            if state == (WHITE_WON if white_to_move else BLACK_WON):
+                self.set_state(index, state)
+            elif self.open_children[index] == 0:
+                state = self.get_proven_state(index, white_to_move)
+                self.set_state(index, state)
+            else:
+                return
+            index = self.parent[index]
+
+    def get_path(self, index):
+        """
+        :param index: The index of a node
+        :return: A numpy array of the node indices from the node up to the root
+        """
+        path = []
+        parent = self.parent
+        while index != -1:
+            path.append(index)
+            index = parent[index]
+        return np.array(path)
+
+    def update_exploration_terms(self, path, visits):
+        visits = np.maximum(visits, 1)
+        self.c_log_visits[path] = self.c * np.log(visits)
+        self.sqrt_c_visits[path] = np.sqrt(self.c * visits)
+
+    def backpropagate(self, index, game_result, white_to_move, count=1):
+        """
+        Adds a game result to every node on the path from a node up to the root
+        :param index: The index of the node the result was obtained from
+        :param game_result: The result from white's perspective, the sum of the results when count > 1
+        :param white_to_move: Whether white is to move at the node
+        :param count: The number of results added
+        """
+        path = self.get_path(index)
+        signs = ALTERNATING_SIGNS[white_to_move][:len(path)]
+        visits = self.visits[path] + count
+        self.visits[path] = visits
+        self.wins[path] += signs * game_result
+        self.update_exploration_terms(path, visits)
+
+    def add_virtual_loss(self, index, weight, count=1):
+        """
+        Counts pending evaluations as lost visits on the path from a node up to the root,
+        steering further selections away from the path until the evaluation is backpropagated
+        :param index: The index of the node pending evaluation
+        :param weight: The loss added to the wins of every node per virtual visit
+        :param count: The number of virtual visits to add, negative to remove them
+        """
+        path = self.get_path(index)
+        visits = self.visits[path] + count
+        self.visits[path] = visits
+        self.wins[path] -= count * weight
+        self.update_exploration_terms(path, visits)
+
+    def get_uct_values(self, start, end, parent):
+        visits = self.visits[start:end]
+        return self.wins[start:end] / visits + np.sqrt(self.c_log_visits[parent] / visits)
+
+    def get_uct_policy_values(self, start, end, parent):
+        visits = self.visits[start:end]
+        return self.wins[start:end] / visits + self.policy[start:end] * self.sqrt_c_visits[parent] / (1 + visits)
+
+    def get_rank_values(self, index, white_to_move, uct_func=get_uct_values):
+        """
+        Vectorized MCTSNode.get_rank_value over the children of a node
+        :param index: The index of the parent node
+        :param white_to_move: Whether white is to move at the parent node
+        :param uct_func: The vectorized UCT function for explored children
+        :return: A numpy array of rank values of the children
+        """
+        start = int(self.first_child[index])
+        count = int(self.child_count[index])
+        end = start + count
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rank = np.tanh(uct_func(self, start, end, index))
+        rank[self.visits[start:end] == 0] = 2
+        if self.open_children[index] < count:
+            states = self.state[start:end]
+            closed = states != OPEN
+            rank[closed] = STATE_RANKS[white_to_move][states[closed]]
+        return rank
+
+    def select(self, index, board, uct_func=get_uct_values):
+        """
+        Descends from a node to the node to expand by taking the highest ranked child at every level
+        :param index: The index of the node to start from
+        :param board: The board of the starting node, the moves of the descent are played on it
+        :param uct_func: The vectorized UCT function for explored children
+        :return: The index of the selected node
+        """
+        white_to_move = board.is_white_to_move()
+        while self.child_count[index] != 0 and self.state[index] == OPEN:
+            index = int(self.first_child[index]) + int(np.argmax(self.get_rank_values(index, white_to_move, uct_func)))
+            board.move(FLAT_MOVES[self.move[index]])
+            white_to_move = not white_to_move
+        return index
+
+    def extract_subtree(self, index):
+        """
+        Copies the subtree below a node into a new compact tree, keeping its statistics and policy priors
+        :param index: The index of the node becoming the root of the new tree
+        :return: The new MCTSTree
+        """
+        # Collect the subtree level by level, the children of consecutive nodes stay contiguous
+        levels = [np.array([index])]
+        while True:
+            level = levels[-1]
+            counts = self.child_count[level].astype(np.int64)
+            expanded = counts > 0
+            if not np.any(expanded):
+                break
+            counts = counts[expanded]
+            starts = self.first_child[level][expanded]
+            levels.append(np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(np.sum(counts)))
+        old = np.concatenate(levels)
+        n = len(old)
+        new_index = np.full(self.size, -1, dtype=np.int32)
+        new_index[old] = np.arange(n)
+
+        tree = MCTSTree(self.get_board(index), c=self.c, capacity=n)
+        tree.size = n
+        for name in MCTSTree.array_names:
+            getattr(tree, name)[:n] = getattr(self, name)[old]
+        parent = tree.parent[1:n]
+        tree.parent[1:n] = new_index[parent]
+        tree.parent[0] = -1
+        tree.move[0] = -1
+        first_child = tree.first_child[:n]
+        tree.first_child[:n] = np.where(first_child == -1, -1, new_index[first_child])
+        return tree
+
+    def get_moves(self, index):
+        """
+        Collects the moves leading from the root to a node
+        :param index: The index of the node
+        :return: A list of moves in tuple form
+        """
+        moves = []
+        while index > 0:
+            moves.append(flat_index_to_move(self.move[index]))
+            index = self.parent[index]
+        moves.reverse()
+        return moves
+
+    def get_board(self, index):
+        """
+        Rebuilds the board of a node by replaying moves from the root board
+        :param index: The index of the node
+        :return: A new Board
+        """
+        board = Board(self.board)
+        for m in self.get_moves(index):
+            board.move(m)
+        return board
+
+    def get_depth(self, index):
+        depth = 0
+        while index > 0:
+            index = self.parent[index]
+            depth += 1
+        return depth
+
+    def is_white_to_move(self, index):
+        return (self.board.plies() + self.get_depth(index)) % 2 == 0
+
+    def nbytes(self):
+        """
+        :return: The number of bytes allocated by the node arrays
+        """
+        return sum(array.nbytes for array in self.arrays())
+
+    def bytes_per_node(self):
+        return sum(array.itemsize for array in self.arrays())
+
+
+class MCTSNode:
+    """
+    View of a single node of an MCTSTree
+    """
+    __slots__ = ('tree', 'index', '_board', '_white_to_move')
+
+    def __init__(self, board: Board = None, c=2.0, tree: MCTSTree = None, index=0):
+        """
+        Creates a view of a node, or the root of a new tree when no tree is given
+        :param board: The board of the root of a new tree
+        :param c: Exploration constant of a new tree
+        :param tree: The MCTSTree holding the node
+        :param index: The index of the node in the tree
+        """
+        self.tree = MCTSTree(board, c=c) if tree is None else tree
+        self.index = index
+        self._board = None
+        self._white_to_move = None
+
+    def __eq__(self, other):
+        return type(other) is MCTSNode and self.tree is other.tree and self.index == other.index
+
+    def __hash__(self):
+        return hash((id(self.tree), self.index))
+
+    @property
+    def board(self):
+        if self._board is None:
+            self._board = self.tree.board if self.index == 0 else self.tree.get_board(self.index)
+        return self._board
+
+    @board.setter
+    def board(self, board):
+        self._board = board
+
+    @property
+    def c(self):
+        return self.tree.c
+
+    @property
+    def wins(self):
+        return float(self.tree.wins[self.index])
+
+    @wins.setter
+    def wins(self, wins):
+        self.tree.wins[self.index] = wins
+
+    @property
+    def visits(self):
+        return int(self.tree.visits[self.index])
+
+    @visits.setter
+    def visits(self, visits):
+        self.tree.visits[self.index] = visits
+
+    @property
+    def policy(self):
+        return float(self.tree.policy[self.index])
+
+    @property
+    def state(self):
+        return STATE_NAMES[self.tree.state[self.index]]
+
+    @state.setter
+    def state(self, state):
+        self.tree.set_state(self.index, STATE_CODES[state])
+
+    @property
+    def parent(self):
+        parent = self.tree.parent[self.index]
+        if parent == -1:
+            return None
+        node = MCTSNode(tree=self.tree, index=int(parent))
+        if self._white_to_move is not None:
+            node._white_to_move = not self._white_to_move
+        return node
+
+    @property
+    def children(self):
+        count = int(self.tree.child_count[self.index])
+        if count == 0:
+            return None
+        start = int(self.tree.first_child[self.index])
+        white_to_move = not self.is_white_to_move()
+        children = []
+        for i in range(start, start + count):
+            child = MCTSNode(tree=self.tree, index=i)
+            child._white_to_move = white_to_move
+            children.append(child)
+        return children
+
+    def is_root(self):
+        return self.tree.parent[self.index] == -1
+
+    def is_leaf(self):
+        return self.tree.child_count[self.index] == 0
+
+    def is_white_to_move(self):
+        if self._white_to_move is None:
+            self._white_to_move = self.tree.is_white_to_move(self.index)
+        return self._white_to_move
 
     def get_win_rate(self):
         return self.wins / self.visits
 
     def get_uct_policy_value(self):
-        return self.get_win_rate() + self.policy * math.sqrt(self.c * self.parent.visits) / (1 + self.visits)
+        parent = self.tree.parent[self.index]
+        return self.get_win_rate() + self.policy * float(self.tree.sqrt_c_visits[parent]) / (1 + self.visits)
 
     def get_uct_value(self):
-        return self.get_win_rate() + math.sqrt(self.c * math.log(self.parent.visits) / self.visits)
+        parent = self.tree.parent[self.index]
+        return self.get_win_rate() + math.sqrt(float(self.tree.c_log_visits[parent]) / self.visits)
 
     def get_rank_value(self, uct_func=get_uct_value):
         '''
@@ -35,72 +456,76 @@ class MCTSNode(TreeNode):
         -2: indicates a losing node for the parent
         :return:
         '''
-        if (self.board.is_white_to_move() and self.state == "WHITE_WON") or \
-                (not self.board.is_white_to_move() and self.state == "BLACK_WON"):
+        state = self.tree.state[self.index]
+        if (self.is_white_to_move() and state == WHITE_WON) or \
+                (not self.is_white_to_move() and state == BLACK_WON):
             return -3
-        if (not self.board.is_white_to_move() and self.state == "WHITE_WON") or \
-                (self.board.is_white_to_move() and self.state == "BLACK_WON"):
+        if (not self.is_white_to_move() and state == WHITE_WON) or \
+                (self.is_white_to_move() and state == BLACK_WON):
             return 3
-        if self.state == "DRAW":
+        if state == DRAW:
             return 0.0
         if self.visits == 0:
             return 2
         return math.tanh(uct_func(self))
 
     def is_terminal_node(self):
-        return self.state != "OPEN" or self.board.is_game_over()
+        return self.tree.state[self.index] != OPEN
 
-    def backpropagate(self, game_result):
-        self.visits += 1
-        self.wins += -game_result if self.board.is_white_to_move() else game_result
-        if not self.is_root():
-            self.parent.backpropagate(game_result)
+    def backpropagate(self, game_result, count=1):
+        self.tree.backpropagate(self.index, game_result, self.is_white_to_move(), count)
+
+    def advance(self, move):
+        """
+        Moves the root of the search to the child reached by a played move, keeping the subtree searched below
+        that child and freeing the rest of the tree
+        :param move: The move played from this node in tuple form
+        :return: The new root MCTSNode, a fresh root when the move was never expanded
+        """
+        count = int(self.tree.child_count[self.index])
+        if count > 0:
+            start = int(self.tree.first_child[self.index])
+            matches = np.flatnonzero(self.tree.move[start:start + count] == move_to_flat_index(move))
+            if len(matches) > 0:
+                return MCTSNode(tree=self.tree.extract_subtree(start + int(matches[0])))
+        board = Board(self.board)
+        board.move(move)
+        return MCTSNode(board, c=self.c)
 
     def expand(self):
-        for m in self.board.get_moves():
-            self.board.move(m)
-            if self.board.is_game_over():
-                game_result = self.board.get_game_result()
-                if game_result == 1:
-                    self.state = "WHITE_WON"
-                    self.add_child(MCTSNode(Board(self.board), state="WHITE_WON"))
-                    self.board.un_move()
-                    return
-                if game_result == -1:
-                    self.state = "BLACK_WON"
-                    self.add_child(MCTSNode(Board(self.board), state="BLACK_WON"))
-                    self.board.un_move()
-                    return
-                if game_result == 0:
-                    self.add_child(MCTSNode(Board(self.board), state="DRAW"))
-            else:
-                self.add_child(MCTSNode(Board(self.board)))
-            self.board.un_move()
+        self.expand_with_policy(None)
 
     def expand_with_policy(self, policy_map):
-        moves = self.board.get_moves()
-        np_moves = moves_to_numpy(moves)
-        policy_map[np_moves == 0] = 0
-        policy_map = policy_map / np.sum(policy_map)
+        """
+        Adds a child for every legal move, stopping at the first move that wins the game
+        :param policy_map: Optional (9, 9) policy map of the neural network
+        """
+        board = self.board
+        moves = board.get_moves()
+        if policy_map is not None:
+            np_moves = moves_to_numpy(moves)
+            policy_map = np.where(np_moves == 0, 0, policy_map)
+            policy_map = policy_map / np.sum(policy_map)
+        flat_moves = []
+        states = []
         for m in moves:
-            self.board.move(m)
-            if self.board.is_game_over():
-                game_result = self.board.get_game_result()
-                if game_result == 1:
-                    self.state = "WHITE_WON"
-                    self.add_child(MCTSNode(Board(self.board), state="WHITE_WON"))
-                    self.board.un_move()
-                    return
-                if game_result == -1:
-                    self.state = "BLACK_WON"
-                    self.add_child(MCTSNode(Board(self.board), state="BLACK_WON"))
-                    self.board.un_move()
-                    return
-                if game_result == 0:
-                    self.add_child(MCTSNode(Board(self.board), state="DRAW"))
+            board.move(m)
+            flat_moves.append(move_to_flat_index(m))
+            if board.is_game_over():
+                state = RESULT_STATES[board.get_game_result()]
+                states.append(state)
+                if state != DRAW:
+                    board.un_move()
+                    break
             else:
-                self.add_child(MCTSNode(Board(self.board), policy=policy_map[move_to_index(m)]))
-            self.board.un_move()
+                states.append(OPEN)
+            board.un_move()
+        policy = None
+        if policy_map is not None:
+            policy = np.reshape(policy_map, 81)[flat_moves]
+            policy[np.array(states) != OPEN] = 0
+        self.tree.add_children(self.index, flat_moves, states, policy)
+        self.tree.update_proven(self.index, self.is_white_to_move())
 
     def to_numpy_training_data(self):
         input_board = self.board.to_numpy()
@@ -116,14 +541,19 @@ class MCTSNode(TreeNode):
                     m = get_last_move(c)
                     p[move_to_index(m)] = 1.0
             p = p / np.sum(p)
+            # Labeled for the side to move like the values of unproven nodes
             v = state_map[self.state]
+            if not self.board.is_white_to_move():
+                v = -v
         else:
             v_array = np.zeros((9, 9))
             for c in self.children:
                 m = get_last_move(c)
                 m_index = move_to_index(m)
                 p[m_index] = c.visits
-                v_array[m_index] = c.wins / c.visits
+                # Children left unvisited by a policy guided search keep a zero value
+                if c.visits > 0:
+                    v_array[m_index] = c.wins / c.visits
 
             p = p / np.sum(p)
             # v = np.sum(v_array * p)  # p weighted v
@@ -132,4 +562,6 @@ class MCTSNode(TreeNode):
 
 
 def get_last_move(node: MCTSNode):
-    return node.board.move_list[node.board.plies() - 1]
+    if node.index == 0:
+        return node.board.move_list[node.board.plies() - 1]
+    return flat_index_to_move(node.tree.move[node.index])
@@ -4,47 +4,169 @@ import random
 import time
 import numpy as np
 
-from MCTNode import MCTSNode, get_last_move
-from Utils import generate_symmetries
+from BatchRollout import stimulate_batch
+from MCTNode import MCTSNode, MCTSTree, STATE_RESULTS, get_last_move
+from TranspositionTable import TranspositionTable
+from GameRecord import GameRecordWriter
+from TrainingShards import ShardWriter
+from EndgameSolver import EndgameSolver
+from OpeningBook import load_book
+from SearchStats import SearchStats
 
 
-def mst_search(root: MCTSNode, timeout=5, max_nodes=1e3):
+def mst_search(root: MCTSNode, timeout=5, max_nodes=1e3, tt=None, rollouts=1, batch_size=1, virtual_loss=1.0,
+               solver=None, stop=None, stats=None):
     """
     Implements a Monte Carlo Tree Search
     :param root: The root MCTSNode to perform the search on
     :param timeout: Timeout duration in seconds
     :param max_nodes: Max nodes searched
-    :return: The root MCTSNode after the search
+    :param tt: Optional TranspositionTable of the rollout results of every expanded position, a leaf transposing
+               an expanded position backs up the stored results instead of playing rollouts
+    :param rollouts: Number of random games played from every expanded leaf
+    :param batch_size: Max number of leaves whose rollouts are played together by stimulate_batch
+    :param virtual_loss: Loss counted for every pending leaf on its selection path while a batch is collected
+    :param solver: Optional EndgameSolver proving the root and the leaves with few empty cells left
+    :param stop: Optional function of the root and the nodes searched so far, called before every iteration,
+                 returning True to end the search early, see TimeManager.MoveTimer.should_stop
+    :param stats: Optional SearchStats accumulating the phase timings and counters of the search
+    :return: The root MCTSNode after the search, a tuple of the root and the stats when stats is given
     """
+    if rollouts > 1 or batch_size > 1:
+        return mst_batch_search(root, timeout, max_nodes, tt, rollouts, batch_size, virtual_loss, solver, stop, stats)
+    search_stats = SearchStats() if stats is None else stats
+    search_stats.begin()
     start = time.time()
     nodes = 0
-    while time.time() - start < timeout and nodes < max_nodes and not root.is_terminal_node():
+    if solver is not None:
+        with search_stats.timer("solver"):
+            solver.prove_children(root)
+    while time.time() - start < timeout and nodes < max_nodes and not root.is_terminal_node() and \
+            (stop is None or not stop(root, nodes)):
         nodes += 1
-        best_node = select_best_node(root)
+        with search_stats.timer("selection"):
+            best_node = select_best_node(root)
+        search_stats.add_depth(best_node.board.plies() - root.board.plies())
+        if solver is not None and not best_node.is_terminal_node():
+            with search_stats.timer("solver"):
+                solver.prove_node(best_node)
         if best_node.is_terminal_node():
-            if best_node.state == "DRAW":
-                best_node.backpropagate(0)
+            search_stats.terminal_hits += 1
+            with search_stats.timer("backpropagation"):
+                best_node.backpropagate(STATE_RESULTS[best_node.state])
+            continue
+        with search_stats.timer("expansion"):
+            best_node.expand()
+        if best_node.state == "WHITE_WON" or best_node.state == "BLACK_WON":
+            with search_stats.timer("backpropagation"):
+                best_node.backpropagate(STATE_RESULTS[best_node.state])
+            continue
+        entry = None if tt is None else tt.get_or_create(best_node.board.hash)
+        if entry is not None and entry.visits > 0:
+            search_stats.cache_hits += 1
+            with search_stats.timer("backpropagation"):
+                best_node.backpropagate(entry.get_mean_result())
+            continue
+        random_node = best_node.children[random.randrange(len(best_node.children))]
+        board = Board(best_node.board)
+        board.move(get_last_move(random_node))
+        with search_stats.timer("rollouts"):
+            result = stimulate(board)
+        if entry is not None:
+            entry.visits += 1
+            entry.wins += result
+        with search_stats.timer("backpropagation"):
+            random_node.backpropagate(result)
+    search_stats.nodes += nodes
+    search_stats.end()
+    return root if stats is None else (root, stats)
+
+
+def mst_batch_search(root: MCTSNode, timeout=5, max_nodes=1e3, tt=None, rollouts=1, batch_size=1,
+                     virtual_loss=1.0, solver=None, stop=None, stats=None):
+    """
+    Monte Carlo Tree Search playing the rollouts of several leaves in one call to stimulate_batch, see mst_search
+    :return: The root MCTSNode after the search, a tuple of the root and the stats when stats is given
+    """
+    # Seeded from random so random.seed keeps searches reproducible
+    rng = np.random.default_rng(random.getrandbits(64))
+    search_stats = SearchStats() if stats is None else stats
+    search_stats.begin()
+    start = time.time()
+    nodes = 0
+    if solver is not None:
+        with search_stats.timer("solver"):
+            solver.prove_children(root)
+    while time.time() - start < timeout and nodes < max_nodes and not root.is_terminal_node() and \
+            (stop is None or not stop(root, nodes)):
+        leaves = []
+        while len(leaves) < min(batch_size, max_nodes - nodes) and not root.is_terminal_node():
+            with search_stats.timer("selection"):
+                best_node = select_best_node(root)
+            search_stats.add_depth(best_node.board.plies() - root.board.plies())
+            if solver is not None and not best_node.is_terminal_node() and best_node not in leaves:
+                with search_stats.timer("solver"):
+                    solver.prove_node(best_node)
+            if best_node.is_terminal_node():
+                nodes += 1
+                search_stats.terminal_hits += 1
+                with search_stats.timer("backpropagation"):
+                    best_node.backpropagate(STATE_RESULTS[best_node.state] * rollouts, rollouts)
                 continue
-            if best_node.state == "WHITE_WON":
-                best_node.backpropagate(1)
+            if best_node in leaves:
+                break
+            best_node.tree.add_virtual_loss(best_node.index, virtual_loss)
+            leaves.append(best_node)
+        if len(leaves) == 0:
+            continue
+        nodes += len(leaves)
+        search_stats.add_batch(len(leaves))
+        boards = []
+        counts = []
+        rollout_nodes = []
+        rollout_entries = []
+        for best_node in leaves:
+            best_node.tree.add_virtual_loss(best_node.index, virtual_loss, count=-1)
+            with search_stats.timer("expansion"):
+                best_node.expand()
+            if best_node.state == "WHITE_WON" or best_node.state == "BLACK_WON":
+                with search_stats.timer("backpropagation"):
+                    best_node.backpropagate(STATE_RESULTS[best_node.state] * rollouts, rollouts)
                 continue
-            if best_node.state == "BLACK_WON":
-                best_node.backpropagate(-1)
+            entry = None if tt is None else tt.get_or_create(best_node.board.hash)
+            if entry is not None and entry.visits > 0:
+                # Weighted like the rollouts of an expanded leaf
+                search_stats.cache_hits += 1
+                count = min(entry.visits, rollouts)
+                with search_stats.timer("backpropagation"):
+                    best_node.backpropagate(entry.get_mean_result() * count, count)
                 continue
-        else:
-            best_node.expand()
-            if best_node.is_terminal_node():
-                if best_node.state == "WHITE_WON":
-                    best_node.backpropagate(1)
-                    continue
-                if best_node.state == "BLACK_WON":
-                    best_node.backpropagate(-1)
-                    continue
-            random_node = best_node.children[random.randrange(len(best_node.children))]
-            result = stimulate(random_node.board)
-            random_node.backpropagate(result)
-    # print("Time:{:0.2f} Nodes:{} NPS:{:0.2f}".format(time.time() - start, nodes, nodes/(time.time() - start)))
-    return root
+            # Every rollout starts from a random child of the leaf
+            children = best_node.children
+            child_counts = np.bincount(rng.integers(len(children), size=rollouts), minlength=len(children))
+            for random_node, count in zip(children, child_counts):
+                if count > 0:
+                    board = Board(best_node.board)
+                    board.move(get_last_move(random_node))
+                    boards.append(board)
+                    counts.append(count)
+                    rollout_nodes.append(random_node)
+                    rollout_entries.append(entry)
+        if len(boards) == 0:
+            continue
+        with search_stats.timer("rollouts"):
+            results = stimulate_batch(boards, counts, rng)
+        offsets = np.cumsum(counts) - counts
+        totals = np.add.reduceat(results.astype(np.float64), offsets)
+        with search_stats.timer("backpropagation"):
+            for random_node, entry, count, total in zip(rollout_nodes, rollout_entries, counts, totals):
+                if entry is not None:
+                    entry.visits += count
+                    entry.wins += total
+                random_node.backpropagate(total, count)
+    search_stats.nodes += nodes
+    search_stats.end()
+    return root if stats is None else (root, stats)
 
 
 def get_best_child(root):
@@ -56,20 +178,17 @@ def get_best_child(root):
         return children[0]
 
 
-def select_best_node(root):
-    while not (root.is_leaf() or root.is_terminal_node()):
-        children = sorted(root.children, key=lambda n: n.get_rank_value(), reverse=True)
-        best_node = children[0]
-        if all([child.is_terminal_node() for child in children]):
-            root.state = best_node.state
-            return root
-        if best_node.is_terminal_node():
-            if best_node.state == "DRAW":
-                return best_node
-            root.state = best_node.state
-            return root
-        root = best_node
-    return root
+def select_best_node(root, uct_func=MCTSTree.get_uct_values):
+    """
+    Descends from the root to the node to expand, replaying the moves on a single board
+    :param root: The root MCTSNode of the search
+    :param uct_func: The vectorized UCT function used to rank explored children
+    :return: The selected MCTSNode with its board attached
+    """
+    board = Board(root.board)
+    node = MCTSNode(tree=root.tree, index=root.tree.select(root.index, board, uct_func))
+    node.board = board
+    return node
 
 
 def stimulate(board: Board) -> int:
@@ -80,24 +199,25 @@ def stimulate(board: Board) -> int:
     return b.get_game_result()
 
 
-def pit(is_white):
+def pit(is_white, book=None):
+    """
+    Plays a search that starts every move from scratch against one that reuses its tree
+    :param is_white: Whether the search without tree reuse plays white
+    :param book: Optional OpeningBook both sides play the book moves of
+    :return: The result from the point of view of the search without tree reuse
+    """
     b = Board()
     m = MCTSNode(b)
     while not b.is_game_over():
-        if is_white == b.is_white_to_move():
-            n = MCTSNode(b)
-            n = mst_search(n)
-            b.move(get_last_move(n))
-        else:
-            if m.board != b and (not (m.children is None)):
-                m = next(filter(lambda node: node.board == b, m.children))
-                if m is None:
-                    print('Error')
-                    raise Exception('Error')
+        move = None if book is None else book.sample_move(b)
+        if move is None and is_white == b.is_white_to_move():
+            n = mst_search(MCTSNode(b))
+            move = get_last_move(get_best_child(n))
+        elif move is None:
             m = mst_search(m)
-            b.move(get_last_move(m))
-            m.parent.children = None
-            m.parent = None
+            move = get_last_move(get_best_child(m))
+        b.move(move)
+        m = m.advance(move)
     return b.get_game_result() if is_white else -b.get_game_result()
 
 
@@ -107,24 +227,30 @@ if __name__ == '__main__':
     #     results = pool.map(pit, sides)
     # print(results)
     b = Board()
-    input_data = []
-    output_p_data = []
-
-    output_v_data = []
-    while not b.is_game_over():
-        print(b)
-        n = MCTSNode(b)
-        n = mst_search(n)
-        training_data = n.to_numpy_training_data()
-        input_data.extend(generate_symmetries(training_data[0], axes=(1, 2)))
-        output_p_data.extend(generate_symmetries(training_data[1]))
-        output_v_data.extend([training_data[2]] * 8)
-        best_child = get_best_child(n)
-        b.move(get_last_move(best_child))
+    tt = TranspositionTable()
+    solver = EndgameSolver()
+    book = load_book()
+    n = MCTSNode(b)
+    samples = []
+    with ShardWriter('bootstrap', metadata={"search": "mst_search"}) as writer:
+        while not b.is_game_over():
+            print(b)
+            move = None if book is None else book.sample_move(b, temperature=1.0)
+            if move is not None:
+                samples.append(book.get_training_data(b))
+            else:
+                n = mst_search(n, tt=tt, solver=solver)
+                samples.append(n.to_numpy_training_data())
+                move = get_last_move(get_best_child(n))
+            writer.add(*samples[-1])
+            b.move(move)
+            n = n.advance(move)
+            print("Reused Nodes:{} Visits:{}".format(n.tree.size, n.visits))
+        writer.end_game()
 
+    with GameRecordWriter('bootstrap.games') as records:
+        records.add_game(b.move_list, b.get_game_result(), samples)
     print(b)
     print(b.get_game_result())
-    input_array = np.array(input_data)
-    output_p_array = np.array(output_p_data)
-    output_v_array = np.array(output_v_data)
-    np.savez('bootstrap', input=input_array, output_p=output_p_array, output_v=output_v_array)
+    print(tt)
+    print(solver)
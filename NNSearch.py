@@ -1,79 +1,125 @@
-from MCTNode import MCTSNode, get_last_move
-from NeuralNetwork import NeuralNetwork
+from MCTNode import MCTSNode, MCTSTree, STATE_RESULTS, get_last_move
 from Board import Board
-from MCTSearch import mst_search
+from MCTSearch import mst_search, get_best_child, select_best_node as mst_select_best_node
+from TranspositionTable import TranspositionTable
+from SearchStats import SearchStats
 import time
 import random
 
 
-def nn_search(root: MCTSNode, nn: NeuralNetwork, timeout=1, max_nodes=1e3):
+def nn_search(root: MCTSNode, nn, timeout=1, max_nodes=1e3, tt=None, batch_size=1, virtual_loss=1.0, verbose=True,
+              solver=None, stop=None, stats=None):
     """
     Implements a Monte Carlo Tree Search with neural network evaluation
     :param root: The root MCTSNode to perform the search on
-    :param nn: The neural network for evaluation
+    :param nn: The neural network for evaluation, anything providing predict_batch(boards, stats=None) like
+               NeuralNetwork
     :param timeout: Timeout duration in seconds
     :param max_nodes: Max nodes searched
-    :return: The root MCTSNode after the search
+    :param tt: Optional TranspositionTable sharing neural network evaluations between transposed nodes
+    :param batch_size: Max number of leaves evaluated together in a single call to the neural network
+    :param virtual_loss: Loss counted for every pending leaf on its selection path while a batch is collected
+    :param verbose: Print the search statistics
+    :param solver: Optional EndgameSolver proving the root and the leaves with few empty cells left
+    :param stop: Optional function of the root and the nodes searched so far returning True to end the search early
+    :param stats: Optional SearchStats accumulating the phase timings and counters of the search
+    :return: The root MCTSNode after the search, a tuple of the root and the stats when stats is given
     """
+    search_stats = SearchStats() if stats is None else stats
+    search_stats.begin()
     start = time.time()
     nodes = 0
-    while time.time() - start < timeout and nodes < max_nodes and not root.is_terminal_node():
-        nodes += 1
-        best_node = select_best_node(root)
-        if best_node.is_terminal_node():
-            if best_node.state == "DRAW":
-                best_node.backpropagate(0)
-                continue
-            if best_node.state == "WHITE_WON":
-                best_node.backpropagate(1)
-                continue
-            if best_node.state == "BLACK_WON":
-                best_node.backpropagate(-1)
-                continue
-        else:
-            p, v = nn.predict(best_node.board)
-            best_node.expand_with_policy(p[0])
+    if solver is not None:
+        with search_stats.timer("solver"):
+            solver.prove_children(root)
+    while time.time() - start < timeout and nodes < max_nodes and not root.is_terminal_node() and \
+            (stop is None or not stop(root, nodes)):
+        leaves = []
+        while len(leaves) < min(batch_size, max_nodes - nodes) and not root.is_terminal_node():
+            with search_stats.timer("selection"):
+                best_node = select_best_node(root)
+            search_stats.add_depth(best_node.board.plies() - root.board.plies())
+            if solver is not None and not best_node.is_terminal_node() and best_node not in leaves:
+                with search_stats.timer("solver"):
+                    solver.prove_node(best_node)
             if best_node.is_terminal_node():
-                if best_node.state == "WHITE_WON":
-                    best_node.backpropagate(1)
-                    continue
-                if best_node.state == "BLACK_WON":
-                    best_node.backpropagate(-1)
+                nodes += 1
+                search_stats.terminal_hits += 1
+                with search_stats.timer("backpropagation"):
+                    best_node.backpropagate(STATE_RESULTS[best_node.state])
+                continue
+            if best_node in leaves:
+                break
+            best_node.tree.add_virtual_loss(best_node.index, virtual_loss)
+            leaves.append(best_node)
+        if len(leaves) == 0:
+            continue
+        nodes += len(leaves)
+        search_stats.add_batch(len(leaves))
+        evaluations = evaluate(leaves, nn, tt, search_stats)
+        for best_node, (p, v) in zip(leaves, evaluations):
+            best_node.tree.add_virtual_loss(best_node.index, virtual_loss, count=-1)
+            with search_stats.timer("expansion"):
+                best_node.expand_with_policy(p)
+            with search_stats.timer("backpropagation"):
+                if best_node.state == "WHITE_WON" or best_node.state == "BLACK_WON":
+                    best_node.backpropagate(STATE_RESULTS[best_node.state])
                     continue
-            best_node.backpropagate(v)
+                best_node.backpropagate(v)
             # next_node = best_node.children[random.randrange(len(best_node.children))]
             # result = stimulate(next_node.board)
             # next_node.backpropagate(result)
+    search_stats.nodes += nodes
+    search_stats.end()
     time_taken = time.time() - start
-    print("Time:{:0.2f} Nodes:{} NPS:{:0.2f}".format(time_taken,
-                                                     nodes,
-                                                     float('inf') if time_taken == 0 else nodes / (
-                                                                 time.time() - start)))
+    if verbose:
+        print("Time:{:0.2f} Nodes:{} NPS:{:0.2f}".format(time_taken,
+                                                         nodes,
+                                                         float('inf') if time_taken == 0 else nodes / (
+                                                                     time.time() - start)))
+        if tt is not None:
+            print(tt)
+        if solver is not None:
+            print(solver)
     # if root.is_terminal_node():
     #     children = sorted(root.children, key=lambda node: node.get_rank_value(), reverse=True)
     #     return children[0]
     # else:
     #     children = sorted(root.children, key=lambda node: node.visits, reverse=True)
     #     return children[0]
-    return root
+    return root if stats is None else (root, stats)
+
+
+def evaluate(nodes, nn, tt=None, stats=None):
+    """
+    Evaluates the boards of several nodes with one call to the neural network,
+    reusing the stored evaluations of transpositions
+    :param nodes: The MCTSNodes to evaluate, with their boards attached
+    :param nn: The neural network for evaluation
+    :param tt: Optional TranspositionTable holding previous evaluations
+    :param stats: Optional SearchStats counting the cache hits, passed on to the network timing the encoding and
+                  the inference
+    :return: A list of (9, 9) policy map and value pairs
+    """
+    entries = [None] * len(nodes) if tt is None else [tt.get_or_create(node.board.hash) for node in nodes]
+    missing = [i for i, entry in enumerate(entries) if entry is None or entry.policy is None]
+    evaluations = [None] * len(nodes)
+    if stats is not None and tt is not None:
+        stats.cache_hits += len(nodes) - len(missing)
+    if len(missing) > 0:
+        p, v = nn.predict_batch([nodes[i].board for i in missing], stats)
+        for k, i in enumerate(missing):
+            evaluations[i] = (p[k], float(v[k][0]))
+            if entries[i] is not None:
+                entries[i].policy, entries[i].value = evaluations[i]
+    for i, entry in enumerate(entries):
+        if evaluations[i] is None:
+            evaluations[i] = (entry.policy, entry.value)
+    return evaluations
 
 
 def select_best_node(root):
-    while not (root.is_leaf() or root.is_terminal_node()):
-        children = sorted(root.children,
-                          key=lambda n: n.get_rank_value(uct_func=MCTSNode.get_uct_policy_value),
-                          reverse=True)
-        best_node = children[0]
-        if all([child.is_terminal_node() for child in children]):
-            root.state = best_node.state
-            return root
-        if best_node.is_terminal_node():
-            if best_node.state == "DRAW":
-                return best_node
-            root.state = best_node.state
-            return root
-        root = best_node
-    return root
+    return mst_select_best_node(root, uct_func=MCTSTree.get_uct_policy_values)
 
 
 def sample_best_move(root):
@@ -91,16 +137,51 @@ def sample_best_move(root):
 
 
 if __name__ == '__main__':
+    from NeuralNetwork import NeuralNetwork
+    from EvaluationCache import EvaluationCache
+    from EndgameSolver import EndgameSolver
+    from OpeningBook import load_book
+    from SearchStats import JsonLinesSink
+    from TimeManager import TimeManager, Ponderer
+
     b = Board()
-    nn = NeuralNetwork()
+    nn = EvaluationCache(NeuralNetwork(), symmetries=True)
+    tt = TranspositionTable()
+    solver = EndgameSolver()
+    book = load_book()
+    # nn_search plays under a clock and ponders while mst_search thinks
+    clock = TimeManager(120.0, increment=1.0)
+    ponderer = Ponderer(lambda root, stop: nn_search(root, nn, timeout=float('inf'), max_nodes=1e6, tt=tt,
+                                                     verbose=False, solver=solver, stop=stop))
+    # Each side keeps its own tree, both are advanced by every move played
+    nn_root = MCTSNode(b)
+    mst_root = MCTSNode(b)
+    sink = JsonLinesSink("search_stats.jsonl")
     while not b.is_game_over():
         print(b)
-        n = MCTSNode(b)
-        if b.is_white_to_move():
-            n = nn_search(n, nn)
-            b.move(sample_best_move(n))
-        else:
-            n = mst_search(n)
-            b.move(get_last_move(n))
+        move = None if book is None else book.sample_move(b)
+        if move is None and b.is_white_to_move():
+            timer = clock.start_move(b)
+            nn_root, stats = nn_search(nn_root, nn, timeout=timer.maximum, max_nodes=1e6, tt=tt, solver=solver,
+                                       stop=timer.should_stop, stats=SearchStats())
+            clock.end_move()
+            sink.write(stats, search="nn_search", ply=b.plies())
+            print(stats)
+            print("Clock:{:0.2f}".format(clock.remaining))
+            move = sample_best_move(nn_root)
+        elif move is None:
+            mst_root, stats = mst_search(mst_root, stats=SearchStats())
+            sink.write(stats, search="mst_search", ply=b.plies())
+            move = get_last_move(get_best_child(mst_root))
+        b.move(move)
+        # The pondered tree becomes the root of nn_search when mst_search played the expected move
+        nn_root = ponderer.stop(nn_root, move)
+        mst_root = mst_root.advance(move)
+        if not b.is_game_over() and not b.is_white_to_move():
+            ponderer.start(nn_root)
+        print("Reused Nodes:{} Visits:{}".format(nn_root.tree.size, nn_root.visits))
+    sink.close()
     print(b)
     print(b.get_game_result())
+    print("Ponder Hits:{} Misses:{}".format(ponderer.hits, ponderer.misses))
+    print(nn)
@@ -3,8 +3,10 @@ from keras.models import load_model
 from keras.layers import *
 from keras.optimizers import Adam
 import numpy as np
-from Board import Board
+from Board import Board, boards_to_numpy
 from functools import reduce
+from ReplayBuffer import ReplayBuffer, prefetch
+from SearchStats import phase_timer
 
 convol_args = {"filters": 256,
                "kernel_size": 3,
@@ -83,17 +85,91 @@ class NeuralNetwork:
     def save_model(self, filename):
         self.model.save(filename)
 
-    def predict(self, board):
-        return self.model.predict(np.array([board.to_numpy()]))
+    def export_numpy(self, filename):
+        """
+        Exports the weights for NumpyNetwork. BatchNormalization layers following a convolution are folded
+        into its weights, the ones of the heads are followed by a relu and are kept as a scale and shift.
+        :param filename: The .npz file to write
+        """
+        layers = self.model.layers
+        # Layer producing every tensor, to follow the graph back from the outputs
+        producers = {id(layer.output): layer for layer in layers}
+
+        def source(layer):
+            return producers[id(layer.input)]
+
+        def batch_norm_affine(bn):
+            gamma, beta, mean, variance = bn.get_weights()
+            scale = gamma / np.sqrt(variance + bn.epsilon)
+            return scale, beta - mean * scale
+
+        weights = {}
+        convolutions = [layer for layer in layers if isinstance(layer, Conv2D)]
+        batch_norms = {id(layer.input): layer for layer in layers if isinstance(layer, BatchNormalization)}
+        for i, conv in enumerate(convolutions):
+            w, b = conv.get_weights()
+            scale, shift = batch_norm_affine(batch_norms[id(conv.output)])
+            weights["conv_w_{}".format(i)] = (w * scale).reshape(-1, w.shape[-1])
+            weights["conv_b_{}".format(i)] = b * scale + shift
+
+        policy_dense = source(self.model.get_layer('pi'))
+        weights["policy_scale"], weights["policy_shift"] = batch_norm_affine(source(source(policy_dense)))
+        weights["policy_w"], weights["policy_b"] = policy_dense.get_weights()
+        value_dense = self.model.get_layer('v')
+        hidden_dense = source(value_dense)
+        weights["value_scale"], weights["value_shift"] = batch_norm_affine(source(source(hidden_dense)))
+        weights["value_w1"], weights["value_b1"] = hidden_dense.get_weights()
+        weights["value_w2"], weights["value_b2"] = value_dense.get_weights()
+        np.savez(filename, **{name: w.astype(np.float32) for name, w in weights.items()})
 
-    def train(self, data):
-        self.model.fit(data['input'], [data['output_p'], data['output_v']], batch_size=100)
+    def predict(self, board):
+        return self.model.predict(boards_to_numpy([board]))
+
+    def predict_batch(self, boards, stats=None):
+        """
+        Evaluates several boards with a single call to the model
+        :param boards: A list of boards
+        :param stats: Optional SearchStats timing the encoding and the inference
+        :return: The policy (N, 9, 9) and value (N, 1) outputs
+        """
+        with phase_timer(stats, "encoding"):
+            x = boards_to_numpy(boards)
+        with phase_timer(stats, "inference"):
+            return self.predict_numpy(x)
+
+    def predict_numpy(self, x):
+        """
+        Evaluates a batch of encoded boards with a single call to the model
+        :param x: A (N, 6, 9, 9) numpy array of encoded boards
+        :return: The policy (N, 9, 9) and value (N, 1) outputs
+        """
+        n = len(x)
+        # Pad to a power of two so the model only ever sees a handful of input shapes
+        size = 1 << (n - 1).bit_length()
+        if size != n:
+            x = np.concatenate([x, np.zeros((size - n,) + NeuralNetwork.input_shape, dtype=x.dtype)])
+        p, v = self.model.predict(x, batch_size=size, verbose=0)
+        return p[:n], v[:n]
+
+    def train(self, data, epochs=1, steps_per_epoch=None):
+        """
+        Trains the model
+        :param data: A ReplayBuffer, or a dict of input, output_p and output_v arrays held in memory
+        :param epochs: Number of epochs
+        :param steps_per_epoch: Minibatches per epoch of a ReplayBuffer, by default one pass over its window
+        """
+        if isinstance(data, dict):
+            self.model.fit(data['input'], [data['output_p'], data['output_v']], batch_size=100, epochs=epochs)
+            return
+        if steps_per_epoch is None:
+            steps_per_epoch = max(len(data) // data.batch_size, 1)
+        self.model.fit(prefetch(data.batches(steps_per_epoch * epochs)), steps_per_epoch=steps_per_epoch,
+                       epochs=epochs, shuffle=False)
 
 
 if __name__ == '__main__':
     nn = NeuralNetwork()
-    bs_data = np.load('bootstrap.npz')
-    print(np.any(np.isnan(bs_data['input'])))
+    bs_data = ReplayBuffer('bootstrap')
     # print(np.all(0 <= bs_data['output_p']))
     # print(np.all(1 >= bs_data['output_p']))
     # print(np.all(np.sum(bs_data['output_p'], axis=(1, 2)) == 1))
@@ -0,0 +1,92 @@
+"""
+Standalone NumPy inference of the network built by NeuralNetwork, from weights exported with
+NeuralNetwork.export_numpy. BatchNormalization is folded into the convolution weights of the tower,
+so every convolution is a single im2col + GEMM with a bias. Keras is not needed at inference time.
+"""
+import numpy as np
+
+from Board import Board, boards_to_numpy
+from SearchStats import phase_timer
+
+residual_blocks = 5
+
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+def sigmoid(x):
+    return 1 / (1 + np.exp(-x))
+
+
+def convolution(x, w, b):
+    """
+    3x3 same convolution as a single matrix product
+    :param x: A (N, 9, 9, C) channels last batch
+    :param w: A (9 * C, F) weight matrix, rows ordered by kernel row, kernel column and channel
+    :param b: A (F,) bias
+    :return: The (N, 9, 9, F) output
+    """
+    n, h, wd, c = x.shape
+    padded = np.zeros((n, h + 2, wd + 2, c), dtype=x.dtype)
+    padded[:, 1:-1, 1:-1] = x
+    # (N, 9, 9, C, 3, 3) windows rearranged to (N * 81, 3 * 3 * C) rows
+    windows = np.lib.stride_tricks.sliding_window_view(padded, (3, 3), axis=(1, 2))
+    columns = windows.transpose(0, 1, 2, 4, 5, 3).reshape(n * h * wd, 9 * c)
+    return (columns @ w + b).reshape(n, h, wd, -1)
+
+
+class NumpyNetwork:
+    """
+    Drop-in replacement of NeuralNetwork for inference
+    """
+    input_shape = Board.tensor_shape
+
+    def __init__(self, filename):
+        """
+        :param filename: A .npz file written by NeuralNetwork.export_numpy
+        """
+        with np.load(filename) as data:
+            self.weights = {name: data[name] for name in data.files}
+        self.conv_count = 1 + 2 * residual_blocks
+
+    def predict(self, board):
+        return self.predict_numpy(boards_to_numpy([board]))
+
+    def predict_batch(self, boards, stats=None):
+        """
+        :param boards: A list of boards
+        :param stats: Optional SearchStats timing the encoding and the inference
+        :return: The policy (N, 9, 9) and value (N, 1) outputs
+        """
+        with phase_timer(stats, "encoding"):
+            x = boards_to_numpy(boards)
+        with phase_timer(stats, "inference"):
+            return self.predict_numpy(x)
+
+    def predict_numpy(self, x):
+        """
+        :param x: A (N, 6, 9, 9) numpy array of encoded boards
+        :return: The policy (N, 9, 9) and value (N, 1) outputs
+        """
+        weights = self.weights
+        n = len(x)
+        x = np.ascontiguousarray(x.transpose(0, 2, 3, 1), dtype=np.float32)
+        x = relu(self.convolution(x, 0))
+        for i in range(1, self.conv_count, 2):
+            y = relu(self.convolution(x, i))
+            x = relu(self.convolution(y, i + 1) + x)
+        # Flatten(data_format="channels_first") moves the channels last before flattening, like this layout
+        features = x.reshape(n, -1)
+        p = relu(features * weights["policy_scale"] + weights["policy_shift"])
+        p = sigmoid(self.dense(p, "policy_w", "policy_b")).reshape(n, 9, 9)
+        v = relu(features * weights["value_scale"] + weights["value_shift"])
+        v = relu(self.dense(v, "value_w1", "value_b1"))
+        v = np.tanh(self.dense(v, "value_w2", "value_b2"))
+        return p, v
+
+    def convolution(self, x, i):
+        return convolution(x, self.weights["conv_w_{}".format(i)], self.weights["conv_b_{}".format(i)])
+
+    def dense(self, x, w, b):
+        return x @ self.weights[w] + self.weights[b]
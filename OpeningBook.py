@@ -0,0 +1,183 @@
+"""
+Opening book of the visit distributions of deep searches of every position up to a given ply.
+Positions are reduced to one of their 8 symmetries, keyed by the Zobrist hash of the canonical position.
+A book file is an .npz of:
+    keys    : (N,) uint64 sorted canonical hashes
+    offsets : (N + 1,) int32 ranges of the moves of every position in moves and weights
+    moves   : uint8 flat move indices (0-80) in the canonical orientation
+    weights : uint16 visit distribution quantized to 65535
+    values  : (N,) float32 value targets of the searches, as in to_numpy_training_data
+    max_ply : the deepest ply of the book
+"""
+import os
+import random
+import sys
+import time
+import numpy as np
+
+from Board import Board, FLAT_MOVES, FLAT_INDEX
+from MCTNode import MCTSNode
+from Utils import apply_symmetry
+
+BOOK_FILE = "opening_book.npz"
+WEIGHT_SCALE = 65535
+# SYMMETRY_PERMUTATIONS[s][i]: flat index the cell i is moved to by the symmetry s of generate_symmetries
+SYMMETRY_PERMUTATIONS = np.zeros((8, 81), dtype=np.int64)
+for _s in range(8):
+    SYMMETRY_PERMUTATIONS[_s, apply_symmetry(np.arange(81).reshape((9, 9)), _s).ravel()] = np.arange(81)
+INVERSE_PERMUTATIONS = np.argsort(SYMMETRY_PERMUTATIONS, axis=1)
+
+
+def canonical_hash(board: Board):
+    """
+    Finds the canonical form of a position among its 8 symmetries by replaying its moves
+    :param board: The board
+    :return: A tuple of the hash of the canonical position and the index of the symmetry mapping the board onto it
+    """
+    moves = [FLAT_INDEX[m] for m in board.move_list]
+    hashes = []
+    for s in range(8):
+        b = Board()
+        for i in SYMMETRY_PERMUTATIONS[s, moves]:
+            b.move(FLAT_MOVES[i])
+        hashes.append(b.hash)
+    index = min(range(8), key=hashes.__getitem__)
+    return hashes[index], index
+
+
+def build_book(filename, search, max_ply=2, verbose=True):
+    """
+    Searches every position up to max_ply once per symmetry class and writes the book
+    :param filename: The .npz file to write
+    :param search: Function searching the root MCTSNode of a position and returning it, e.g. a deep mst_search
+    :param max_ply: Number of moves of the deepest positions of the book
+    :param verbose: Print the progress of every ply
+    """
+    entries = {}
+    frontier = [Board()]
+    for ply in range(max_ply + 1):
+        start = time.time()
+        next_frontier = []
+        for b in frontier:
+            key, symmetry = canonical_hash(b)
+            if key in entries or b.is_game_over():
+                continue
+            _, p, v = search(MCTSNode(b)).to_numpy_training_data()
+            p = apply_symmetry(p, symmetry).ravel()
+            moves = np.flatnonzero(p > 0)
+            entries[key] = (moves, p[moves], v)
+            if ply < max_ply:
+                for m in b.get_moves():
+                    child = Board(b)
+                    child.move(m)
+                    next_frontier.append(child)
+        if verbose:
+            print("Ply:{} Positions:{} Entries:{} Time:{:0.2f}".format(ply, len(frontier), len(entries),
+                                                                      time.time() - start))
+        frontier = next_frontier
+    write_book(filename, entries, max_ply)
+
+
+def write_book(filename, entries, max_ply):
+    """
+    :param filename: The .npz file to write
+    :param entries: A dict of canonical hash to (canonical flat moves, visit distribution, value)
+    :param max_ply: The deepest ply of the book
+    """
+    keys = sorted(entries)
+    moves = [entries[key][0] for key in keys]
+    weights = [np.round(entries[key][1] / np.sum(entries[key][1]) * WEIGHT_SCALE) for key in keys]
+    np.savez(filename,
+             keys=np.array(keys, dtype=np.uint64),
+             offsets=np.concatenate([[0], np.cumsum([len(m) for m in moves])]).astype(np.int32),
+             moves=np.concatenate(moves).astype(np.uint8),
+             weights=np.concatenate(weights).astype(np.uint16),
+             values=np.array([entries[key][2] for key in keys], dtype=np.float32),
+             max_ply=np.array(max_ply))
+
+
+class OpeningBook:
+    """
+    Read access to a book written by build_book
+    """
+
+    def __init__(self, filename=BOOK_FILE):
+        with np.load(filename) as data:
+            self.keys = data["keys"]
+            self.offsets = data["offsets"]
+            self.moves = data["moves"]
+            self.weights = data["weights"]
+            self.values = data["values"]
+            self.max_ply = int(data["max_ply"])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def probe(self, board: Board):
+        """
+        :param board: The board
+        :return: A tuple of the moves in tuple form, their (n,) visit distribution and the value of the position,
+                 None when the position is not in the book
+        """
+        if board.plies() > self.max_ply or board.is_game_over():
+            return None
+        key, symmetry = canonical_hash(board)
+        i = int(np.searchsorted(self.keys, np.uint64(key)))
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        start, end = self.offsets[i], self.offsets[i + 1]
+        moves = [FLAT_MOVES[j] for j in INVERSE_PERMUTATIONS[symmetry, self.moves[start:end]]]
+        weights = self.weights[start:end].astype(np.float32)
+        return moves, weights / np.sum(weights), float(self.values[i])
+
+    def sample_move(self, board: Board, temperature=0.0, rng=random):
+        """
+        :param board: The board
+        :param temperature: 0 for the most visited move, otherwise moves are sampled from the visit distribution
+                            raised to 1 / temperature
+        :param rng: The random generator of the sampling
+        :return: A move in tuple form or None when the position is not in the book
+        """
+        entry = self.probe(board)
+        if entry is None:
+            return None
+        moves, weights, _ = entry
+        if temperature == 0:
+            return moves[int(np.argmax(weights))]
+        weights = weights ** (1 / temperature)
+        return rng.choices(moves, weights)[0]
+
+    def get_training_data(self, board: Board):
+        """
+        :param board: A board in the book
+        :return: An (input, policy, value) sample of the position, like MCTSNode.to_numpy_training_data
+        """
+        moves, weights, v = self.probe(board)
+        p = np.zeros(81)
+        p[[FLAT_INDEX[m] for m in moves]] = weights
+        return board.to_numpy(), p.reshape((9, 9)), v
+
+
+def load_book(filename=BOOK_FILE):
+    """
+    :return: The OpeningBook of a file, None when the file does not exist
+    """
+    return OpeningBook(filename) if os.path.exists(filename) else None
+
+
+if __name__ == '__main__':
+    # OpeningBook.py [max ply] [model file], searched with mst_search without a model file
+    from MCTSearch import mst_search
+
+    book_ply = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    if len(sys.argv) > 2:
+        from NNSearch import nn_search
+        from SelfPlay import load_network
+
+        network = load_network(sys.argv[2])
+        build_book(BOOK_FILE, lambda root: nn_search(root, network, timeout=float('inf'), max_nodes=20000,
+                                                     batch_size=16, verbose=False), book_ply)
+    else:
+        build_book(BOOK_FILE, lambda root: mst_search(root, timeout=float('inf'), max_nodes=20000, batch_size=16),
+                   book_ply)
+    print("Entries:{} Size:{} bytes".format(len(OpeningBook(BOOK_FILE)), os.path.getsize(BOOK_FILE)))
@@ -0,0 +1,154 @@
+import random
+import threading
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from Board import Board
+from MCTNode import MCTSNode, OPEN, STATE_RESULTS, get_last_move
+from MCTSearch import mst_search, select_best_node, stimulate, get_best_child
+
+
+def search_root(board, timeout, max_nodes, seed):
+    """
+    Runs mst_search on a new tree in a worker process
+    :param board: The board of the root
+    :param timeout: Timeout duration in seconds
+    :param max_nodes: Max nodes searched
+    :param seed: Seed of the rollouts
+    :return: A tuple of (root visits, root wins, child visits, child wins, child states) numpy arrays
+    """
+    random.seed(seed)
+    root = mst_search(MCTSNode(board), timeout=timeout, max_nodes=max_nodes)
+    tree = root.tree
+    start = int(tree.first_child[0])
+    end = start + int(tree.child_count[0])
+    return tree.visits[0], tree.wins[0], tree.visits[start:end].copy(), tree.wins[start:end].copy(), \
+        tree.state[start:end].copy()
+
+
+def merge_root_statistics(root: MCTSNode, statistics):
+    """
+    Adds the root statistics of independent searches of the same position to a node
+    :param root: The node the searches started from, expanded if it is still a leaf
+    :param statistics: A list of search_root results
+    """
+    if root.is_leaf():
+        root.expand()
+    tree = root.tree
+    start = int(tree.first_child[root.index])
+    end = start + int(tree.child_count[root.index])
+    for root_visits, root_wins, visits, wins, states in statistics:
+        tree.visits[root.index] += root_visits
+        tree.wins[root.index] += root_wins
+        if len(visits) == 0:
+            continue
+        tree.visits[start:end] += visits
+        tree.wins[start:end] += wins
+        # A proof found by any search holds for the merged tree
+        for i in np.flatnonzero((states != OPEN) & (tree.state[start:end] == OPEN)):
+            tree.set_state(start + int(i), states[i])
+    tree.update_exploration_terms(np.array([root.index]), tree.visits[root.index])
+    tree.update_exploration_terms(np.arange(start, end), tree.visits[start:end])
+    tree.update_proven(root.index, root.is_white_to_move())
+
+
+def root_parallel_search(root: MCTSNode, timeout=5, max_nodes=1e3, workers=4, executor=None):
+    """
+    Root parallel Monte Carlo Tree Search, every worker process searches its own tree of the root position
+    and the root child statistics of all trees are merged into the root
+    :param root: The root MCTSNode to perform the search on
+    :param timeout: Timeout duration in seconds
+    :param max_nodes: Max nodes searched, split evenly between the workers
+    :param workers: Number of worker processes
+    :param executor: Optional ProcessPoolExecutor to reuse between searches
+    :return: The root MCTSNode after the search
+    """
+    if root.is_terminal_node():
+        return root
+    pool = ProcessPoolExecutor(workers) if executor is None else executor
+    try:
+        nodes = [int(max_nodes) // workers + (i < int(max_nodes) % workers) for i in range(workers)]
+        futures = [pool.submit(search_root, root.board, timeout, nodes[i], random.getrandbits(64))
+                   for i in range(workers)]
+        merge_root_statistics(root, [future.result() for future in futures])
+    finally:
+        if executor is None:
+            pool.shutdown()
+    return root
+
+
+def tree_parallel_search(root: MCTSNode, timeout=5, max_nodes=1e3, workers=4, virtual_loss=1.0):
+    """
+    Tree parallel Monte Carlo Tree Search, worker threads share a single tree and rely on virtual loss to
+    spread their selections. The tree is only modified under a lock, rollouts run concurrently.
+    :param root: The root MCTSNode to perform the search on
+    :param timeout: Timeout duration in seconds
+    :param max_nodes: Max nodes searched by all workers together
+    :param workers: Number of worker threads
+    :param virtual_loss: Loss counted for every pending rollout on its selection path
+    :return: The root MCTSNode after the search
+    """
+    lock = threading.Lock()
+    start = time.time()
+    nodes = [0]
+
+    def work():
+        while True:
+            with lock:
+                if time.time() - start >= timeout or nodes[0] >= max_nodes or root.is_terminal_node():
+                    return
+                nodes[0] += 1
+                best_node = select_best_node(root)
+                if best_node.is_terminal_node():
+                    best_node.backpropagate(STATE_RESULTS[best_node.state])
+                    continue
+                best_node.expand()
+                if best_node.state == "WHITE_WON" or best_node.state == "BLACK_WON":
+                    best_node.backpropagate(STATE_RESULTS[best_node.state])
+                    continue
+                children = best_node.children
+                random_node = children[random.randrange(len(children))]
+                board = Board(best_node.board)
+                board.move(get_last_move(random_node))
+                random_node.tree.add_virtual_loss(random_node.index, virtual_loss)
+            result = stimulate(board)
+            with lock:
+                random_node.tree.add_virtual_loss(random_node.index, virtual_loss, count=-1)
+                random_node.backpropagate(result)
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return root
+
+
+def parallel_search(root: MCTSNode, timeout=5, max_nodes=1e3, workers=4, mode="root", executor=None):
+    """
+    Parallel Monte Carlo Tree Search with the same contract as mst_search
+    :param root: The root MCTSNode to perform the search on
+    :param timeout: Timeout duration in seconds
+    :param max_nodes: Max nodes searched by all workers together
+    :param workers: Number of workers
+    :param mode: "root" for independent trees in worker processes, "tree" for threads sharing one tree
+    :param executor: Optional ProcessPoolExecutor reused by root parallel searches
+    :return: The root MCTSNode after the search
+    """
+    if mode == "root":
+        return root_parallel_search(root, timeout, max_nodes, workers, executor)
+    if mode == "tree":
+        return tree_parallel_search(root, timeout, max_nodes, workers)
+    raise ValueError("Unknown parallel search mode {}".format(mode))
+
+
+if __name__ == '__main__':
+    b = Board()
+    with ProcessPoolExecutor(4) as pool:
+        while not b.is_game_over():
+            print(b)
+            n = parallel_search(MCTSNode(b), max_nodes=4000, executor=pool)
+            b.move(get_last_move(get_best_child(n)))
+    print(b)
+    print(b.get_game_result())
@@ -0,0 +1,110 @@
+"""
+Perft move generator test for Board.
+Counts the positions reached after exactly N plies and compares them with stored reference counts.
+"""
+import sys
+import time
+
+from Board import Board
+
+# (name, moves played from the start position, reference counts for depth 1, 2, ...)
+PERFT_POSITIONS = [
+    ("start", [], [81, 720, 6336, 55080, 473256, 4020960]),
+    ("ply12", [(6, 64), (6, 4), (2, 16), (4, 8), (3, 64), (6, 256), (8, 16), (4, 16), (4, 128), (7, 128), (7, 32),
+               (5, 64)],
+     [6, 47, 358, 2752, 20914, 160387]),
+    ("ply24", [(7, 16), (4, 8), (3, 16), (4, 64), (6, 256), (8, 2), (1, 8), (3, 256), (8, 8), (3, 32), (5, 8), (3, 8),
+               (3, 1), (0, 32), (5, 128), (7, 256), (8, 1), (0, 4), (2, 32), (5, 16), (4, 4), (2, 64), (6, 8), (3, 64)],
+     [7, 47, 299, 2000, 13132, 93462]),
+    ("ply40", [(6, 1), (0, 64), (6, 64), (6, 32), (5, 8), (3, 64), (6, 4), (2, 8), (3, 1), (0, 8), (3, 256), (8, 1),
+               (0, 256), (8, 32), (5, 64), (6, 256), (8, 256), (8, 128), (7, 64), (6, 2), (1, 32), (5, 256), (8, 64),
+               (6, 8), (3, 4), (2, 256), (8, 8), (3, 8), (3, 16), (4, 32), (5, 16), (4, 4), (2, 4), (2, 32), (5, 128),
+               (7, 32), (5, 4), (2, 64), (6, 16), (4, 128)],
+     [7, 66, 709, 7073, 72007, 665973]),
+]
+
+
+def perft(board: Board, depth):
+    """
+    Counts the positions reached after exactly depth plies, finished games count as no position
+    :param board: The board to start from, restored after the count
+    :param depth: Number of plies, at least 1
+    :return: The number of positions
+    """
+    if board.is_game_over():
+        return 0
+    moves = board.get_moves()
+    if depth == 1:
+        return len(moves)
+    nodes = 0
+    for m in moves:
+        board.move(m)
+        nodes += perft(board, depth - 1)
+        board.un_move()
+    return nodes
+
+
+def get_state(board: Board):
+    return (tuple(board.white), tuple(board.black), board.global_white, board.global_black, board.decided,
+            board.hash, board.result)
+
+
+def perft_checked(board: Board, depth):
+    """
+    Same count as perft, also checking that un_move restores every incrementally updated field of the board
+    :raise AssertionError: if un_move does not restore the board
+    """
+    if board.is_game_over():
+        return 0
+    moves = board.get_moves()
+    if depth == 1:
+        return len(moves)
+    state = get_state(board)
+    nodes = 0
+    for m in moves:
+        board.move(m)
+        nodes += perft_checked(board, depth - 1)
+        board.un_move()
+        assert get_state(board) == state, "un_move of {} did not restore the board".format(m)
+    return nodes
+
+
+def get_position(moves):
+    board = Board()
+    for m in moves:
+        board.move(m)
+    return board
+
+
+def run_perft(max_depth=5, checked=False):
+    """
+    Runs perft on every stored position up to a depth
+    :param max_depth: Max depth, capped by the stored reference counts
+    :param checked: Use perft_checked instead of perft
+    :return: A list of dicts with the name, depth, nodes, expected nodes and nodes per second of every run
+    """
+    count = perft_checked if checked else perft
+    results = []
+    for name, moves, expected in PERFT_POSITIONS:
+        board = get_position(moves)
+        for depth in range(1, min(max_depth, len(expected)) + 1):
+            start = time.perf_counter()
+            nodes = count(board, depth)
+            elapsed = time.perf_counter() - start
+            results.append({"name": name,
+                            "depth": depth,
+                            "nodes": nodes,
+                            "expected": expected[depth - 1],
+                            "nps": nodes / elapsed if elapsed > 0 else float('inf')})
+    return results
+
+
+if __name__ == '__main__':
+    depth = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    failed = 0
+    for r in run_perft(depth) + run_perft(min(depth, 4), checked=True):
+        ok = r["nodes"] == r["expected"]
+        failed += not ok
+        print("Position:{name} Depth:{depth} Nodes:{nodes} Expected:{expected} NPS:{nps:0.2f}".format(**r),
+              "OK" if ok else "FAILED")
+    sys.exit(1 if failed else 0)
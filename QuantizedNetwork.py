@@ -0,0 +1,190 @@
+"""
+Accuracy simulation of post-training quantization of the weights exported by NeuralNetwork.export_numpy.
+int8 mode stores the convolution and dense weights as int8 with a scale per output channel and quantizes
+the input of every layer with a per-tensor scale calibrated on self-play positions, unsigned for the
+relu outputs. float16 mode stores the weights and rounds the layer inputs to float16.
+QuantizedNetwork dequantizes the weights at load and runs the float32 GEMMs on the quantization grid, which
+matches integer accumulation up to float32 rounding. It measures the loss of accuracy and playing strength of a
+quantized model, it is not faster than NumpyNetwork: NumPy has no int8 or float16 matrix product kernels, both run
+orders of magnitude slower than the float32 BLAS product, so a speedup needs a runtime with such kernels.
+"""
+import random
+import sys
+import numpy as np
+
+from Board import Board
+from MCTNode import MCTSNode
+from NNSearch import nn_search, sample_best_move
+from NumpyNetwork import NumpyNetwork, convolution
+
+QUANTIZED_WEIGHTS = ["conv_w_{}".format(i) for i in range(11)] + ["policy_w", "value_w1", "value_w2"]
+QUANTIZATION_SUFFIXES = ("_scale", "_input_scale", "_input_min", "_input_max")
+MODES = ("int8", "float16")
+
+
+class CalibrationNetwork(NumpyNetwork):
+    """
+    NumpyNetwork recording the range of the input of every quantized layer
+    """
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.ranges = {}
+
+    def record(self, x, w):
+        low, high = self.ranges.get(w, (0.0, 0.0))
+        self.ranges[w] = (min(low, float(np.min(x))), max(high, float(np.max(x))))
+
+    def convolution(self, x, i):
+        self.record(x, "conv_w_{}".format(i))
+        return super().convolution(x, i)
+
+    def dense(self, x, w, b):
+        self.record(x, w)
+        return super().dense(x, w, b)
+
+
+def quantize(filename, output, x, mode="int8"):
+    """
+    Quantizes exported weights
+    :param filename: A .npz file written by NeuralNetwork.export_numpy
+    :param output: The quantized .npz file to write
+    :param x: A (N, 6, 9, 9) array of calibration positions, e.g. from self-play data
+    :param mode: "int8" or "float16"
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown quantization mode {}".format(mode))
+    network = CalibrationNetwork(filename)
+    if mode == "int8":
+        for i in range(0, len(x), 64):
+            network.predict_numpy(x[i:i + 64])
+    quantized = {"mode": np.array(mode)}
+    for name, w in network.weights.items():
+        if name not in QUANTIZED_WEIGHTS:
+            quantized[name] = w
+        elif mode == "float16":
+            quantized[name] = w.astype(np.float16)
+        else:
+            # Symmetric weights per output channel, inputs per tensor, unsigned when never negative
+            scale = np.maximum(np.max(np.abs(w), axis=0), 1e-12) / 127
+            quantized[name] = np.round(w / scale).astype(np.int8)
+            quantized[name + "_scale"] = scale.astype(np.float32)
+            low, high = network.ranges[name]
+            levels = 255 if low >= 0 else 127
+            quantized[name + "_input_scale"] = np.float32(max(high, -low, 1e-12) / levels)
+            quantized[name + "_input_min"] = np.float32(0 if low >= 0 else -127)
+            quantized[name + "_input_max"] = np.float32(levels)
+    np.savez(output, **quantized)
+
+
+class QuantizedNetwork(NumpyNetwork):
+    """
+    Drop-in replacement of NeuralNetwork simulating the arithmetic of a network quantized by quantize,
+    slower than NumpyNetwork by the rounding of every layer input
+    """
+
+    def __init__(self, filename):
+        """
+        :param filename: A .npz file written by quantize
+        """
+        with np.load(filename) as data:
+            stored = {name: data[name] for name in data.files}
+        self.mode = str(stored.pop("mode"))
+        self.input_quantization = {}
+        self.weights = {}
+        quantization_names = {name + suffix for name in QUANTIZED_WEIGHTS for suffix in QUANTIZATION_SUFFIXES}
+        for name, w in stored.items():
+            if name in quantization_names:
+                continue
+            if name in QUANTIZED_WEIGHTS and self.mode == "int8":
+                self.weights[name] = w.astype(np.float32) * stored[name + "_scale"]
+                self.input_quantization[name] = (stored[name + "_input_scale"], stored[name + "_input_min"],
+                                                 stored[name + "_input_max"])
+            else:
+                self.weights[name] = w.astype(np.float32)
+        self.conv_count = sum(name.startswith("conv_w_") for name in self.weights)
+
+    def quantize_input(self, x, w):
+        if self.mode == "float16":
+            return x.astype(np.float16).astype(np.float32)
+        scale, low, high = self.input_quantization[w]
+        return np.clip(np.round(x / scale), low, high) * scale
+
+    def convolution(self, x, i):
+        w = "conv_w_{}".format(i)
+        return convolution(self.quantize_input(x, w), self.weights[w], self.weights["conv_b_{}".format(i)])
+
+    def dense(self, x, w, b):
+        return self.quantize_input(x, w) @ self.weights[w] + self.weights[b]
+
+
+def calibration_positions(directory, count=1024, seed=0):
+    """
+    Samples positions of the self-play data for calibration
+    :param directory: A directory of shards written by ShardWriter
+    :param count: Number of positions
+    :param seed: Seed of the sampling
+    :return: A (count, 6, 9, 9) array
+    """
+    from ReplayBuffer import ReplayBuffer
+
+    return ReplayBuffer(directory, batch_size=count, seed=seed).sample_batch()[0]
+
+
+def compare_outputs(reference, network, x):
+    """
+    Compares the outputs of two networks
+    :param reference: The float32 network
+    :param network: The quantized network
+    :param x: A (N, 6, 9, 9) array of positions
+    :return: A tuple of the mean KL divergence of the normalized policies and the value mean squared error
+    """
+    p, v = reference.predict_numpy(x)
+    q, w = network.predict_numpy(x)
+    p = p.reshape(len(x), -1) / np.sum(p, axis=(1, 2))[:, None]
+    q = q.reshape(len(x), -1) / np.sum(q, axis=(1, 2))[:, None]
+    kl = np.sum(p * (np.log(np.maximum(p, 1e-12)) - np.log(np.maximum(q, 1e-12))), axis=1)
+    return float(np.mean(kl)), float(np.mean((v - w) ** 2))
+
+
+def play_match(network, reference, games=10, max_nodes=100, seed=0):
+    """
+    Plays nn_search games between two networks, alternating colors
+    :param network: The network under test
+    :param reference: The reference network
+    :param games: Number of games
+    :param max_nodes: Max nodes searched per move
+    :param seed: Seed of the move sampling
+    :return: A tuple of wins, draws and losses of network
+    """
+    score = [0, 0, 0]
+    for game in range(games):
+        random.seed(seed + game)
+        networks = (network, reference) if game % 2 == 0 else (reference, network)
+        b = Board()
+        roots = [MCTSNode(b), MCTSNode(b)]
+        while not b.is_game_over():
+            side = 0 if b.is_white_to_move() else 1
+            roots[side] = nn_search(roots[side], networks[side], timeout=float('inf'), max_nodes=max_nodes,
+                                    batch_size=8, verbose=False)
+            move = sample_best_move(roots[side])
+            b.move(move)
+            roots = [root.advance(move) for root in roots]
+        result = b.get_game_result() * (1 if game % 2 == 0 else -1)
+        score[1 - result] += 1
+    return tuple(score)
+
+
+if __name__ == '__main__':
+    # QuantizedNetwork.py <exported .npz> <self-play shard directory>
+    model_file, data_directory = sys.argv[1], sys.argv[2]
+    x = calibration_positions(data_directory)
+    reference = NumpyNetwork(model_file)
+    test_x = calibration_positions(data_directory, seed=1)
+    for mode in MODES:
+        output = model_file[:-len(".npz")] + "_" + mode + ".npz"
+        quantize(model_file, output, x, mode)
+        network = QuantizedNetwork(output)
+        kl, mse = compare_outputs(reference, network, test_x)
+        print("Mode:{} PolicyKL:{:0.6f} ValueMSE:{:0.6f}".format(mode, kl, mse))
+        print("Mode:{} Wins:{} Draws:{} Losses:{}".format(mode, *play_match(network, reference)))
@@ -0,0 +1,123 @@
+import itertools
+import queue
+import threading
+import numpy as np
+
+from TrainingShards import list_shards, read_metadata, read_shard
+from Utils import apply_symmetry
+
+
+class ReplayBuffer:
+    """
+    Training samples of the most recent games, read from memory-mapped shards of a ShardWriter directory
+    so the data set is not bound by memory
+    """
+
+    def __init__(self, directory, window=100000, batch_size=256, augment=True, seed=None):
+        """
+        :param directory: The directory of the shards
+        :param window: Number of most recent games sampled from
+        :param batch_size: Number of samples per minibatch
+        :param augment: Apply a random symmetry of generate_symmetries to every sample
+        :param seed: Seed of the sampling
+        """
+        self.directory = directory
+        self.window = window
+        self.batch_size = batch_size
+        self.augment = augment
+        self.rng = np.random.default_rng(seed)
+        self.shards = []
+        self.starts = np.zeros(1, dtype=np.int64)
+        self.refresh()
+
+    def refresh(self):
+        """
+        Maps the shards holding the games of the window, picking up shards written since the last refresh
+        """
+        paths = list_shards(self.directory)
+        metadata = [read_metadata(path) for path in paths]
+        last_game = metadata[-1]["last_game"] if len(metadata) > 0 else -1
+        first_game = last_game - self.window + 1
+        self.shards = []
+        sizes = []
+        for path, meta in zip(paths, metadata):
+            if meta["last_game"] < first_game:
+                continue
+            data = read_shard(path)
+            # Shards are written in game order, only the first shard of the window can start before it
+            offset = int(np.searchsorted(data["game"], first_game)) if meta["first_game"] < first_game else 0
+            self.shards.append((data, offset))
+            sizes.append(meta["samples"] - offset)
+        self.starts = np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def sample_batch(self):
+        """
+        Draws a random minibatch from the window
+        :return: A tuple of the (N, 6, 9, 9) inputs and a tuple of the (N, 9, 9) policy and (N, 1) value targets
+        """
+        self.check_samples()
+        indices = np.sort(self.rng.integers(len(self), size=self.batch_size))
+        shard_indices = np.searchsorted(self.starts, indices, side='right') - 1
+        x = np.empty((self.batch_size, 6, 9, 9), dtype=np.float32)
+        p = np.empty((self.batch_size, 9, 9), dtype=np.float32)
+        v = np.empty((self.batch_size, 1), dtype=np.float32)
+        for shard_index in np.unique(shard_indices):
+            rows = np.flatnonzero(shard_indices == shard_index)
+            data, offset = self.shards[shard_index]
+            positions = indices[rows] - self.starts[shard_index] + offset
+            x[rows] = data["input"][positions]
+            p[rows] = data["policy"][positions]
+            v[rows, 0] = data["value"][positions]
+        if self.augment:
+            symmetries = self.rng.integers(8, size=self.batch_size)
+            for symmetry in range(1, 8):
+                rows = np.flatnonzero(symmetries == symmetry)
+                x[rows] = apply_symmetry(x[rows], symmetry, axes=(2, 3))
+                p[rows] = apply_symmetry(p[rows], symmetry, axes=(1, 2))
+        return x, (p, v)
+
+    def batches(self, count=None):
+        """
+        :param count: Number of minibatches, unlimited when None
+        :return: A generator of minibatches, see sample_batch
+        """
+        # Checked here as the generator only runs once the first minibatch is requested
+        self.check_samples()
+        return (self.sample_batch() for _ in (itertools.count() if count is None else range(count)))
+
+    def check_samples(self):
+        if len(self) == 0:
+            raise ValueError("No training samples in the shards of {}".format(self.directory))
+
+
+def prefetch(batches, buffer_size=4):
+    """
+    Produces the items of a generator in a background thread so they are ready when requested
+    :param batches: The generator of items
+    :param buffer_size: Max number of items produced ahead
+    :return: A generator of the same items
+    """
+    items = queue.Queue(buffer_size)
+    done = object()
+
+    def produce():
+        try:
+            for item in batches:
+                items.put((item, None))
+        except BaseException as error:
+            items.put((done, error))
+            return
+        items.put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    while True:
+        item, error = items.get()
+        if error is not None:
+            raise error
+        if item is done:
+            return
+        yield item
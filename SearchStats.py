@@ -0,0 +1,157 @@
+"""
+Instrumentation of mst_search and nn_search.
+A SearchStats accumulates the time spent in every phase of the searches and counters of the searched trees,
+over one or several searches. The searches return it alongside the root when one is passed in.
+"""
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import time
+
+PHASES = ("selection", "expansion", "encoding", "inference", "rollouts", "backpropagation", "solver")
+NO_TIMER = contextlib.nullcontext()
+
+
+class PhaseTimer:
+    """
+    Context manager adding the time spent in its block to one phase of a SearchStats
+    """
+    __slots__ = ('times', 'phase', 'start')
+
+    def __init__(self, times, phase):
+        self.times = times
+        self.phase = phase
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.times[self.phase] += time.perf_counter() - self.start
+
+
+def phase_timer(stats, phase):
+    """
+    :param stats: A SearchStats or None
+    :param phase: The phase of PHASES
+    :return: The timer of the phase, a context manager doing nothing when stats is None
+    """
+    return NO_TIMER if stats is None else stats.timers[phase]
+
+
+class SearchStats:
+    """
+    Per phase timers and counters of searches
+    times           : seconds spent in every phase of PHASES
+    nodes           : number of nodes searched
+    max_depth       : deepest selected leaf below the root
+    terminal_hits   : selections ending in a proven node
+    cache_hits      : leaves whose evaluation or rollout results came from the TranspositionTable
+    batch_sizes     : number of batches of every size evaluated by the network or played out together
+    """
+
+    def __init__(self, profile=False):
+        """
+        :param profile: Run cProfile during the searches, see print_profile
+        """
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.timers = {phase: PhaseTimer(self.times, phase) for phase in PHASES}
+        self.nodes = 0
+        self.max_depth = 0
+        self.terminal_hits = 0
+        self.cache_hits = 0
+        self.batch_sizes = {}
+        self.searches = 0
+        self.total_time = 0.0
+        self.profiler = cProfile.Profile() if profile else None
+        self.start = 0.0
+
+    def begin(self):
+        """
+        Called by the searches when they start
+        """
+        self.searches += 1
+        self.start = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def end(self):
+        """
+        Called by the searches when they end
+        """
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.total_time += time.perf_counter() - self.start
+
+    def timer(self, phase):
+        return self.timers[phase]
+
+    def add_depth(self, depth):
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def add_batch(self, size):
+        self.batch_sizes[size] = self.batch_sizes.get(size, 0) + 1
+
+    def mean_batch_size(self):
+        batches = sum(self.batch_sizes.values())
+        return sum(size * count for size, count in self.batch_sizes.items()) / batches if batches > 0 else 0.0
+
+    def to_dict(self):
+        other = self.total_time - sum(self.times.values())
+        return {"searches": self.searches,
+                "time": self.total_time,
+                "nodes": self.nodes,
+                "nps": self.nodes / self.total_time if self.total_time > 0 else 0.0,
+                "times": {**self.times, "other": other},
+                "max_depth": self.max_depth,
+                "terminal_hits": self.terminal_hits,
+                "cache_hits": self.cache_hits,
+                "mean_batch_size": self.mean_batch_size(),
+                "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())}}
+
+    def print_profile(self, sort="cumulative", limit=20):
+        """
+        Prints the functions taking the most time in the profiled searches
+        :param sort: The pstats sort key
+        :param limit: Number of functions printed
+        """
+        if self.profiler is None:
+            raise ValueError("The searches were not profiled, create the SearchStats with profile=True")
+        stream = io.StringIO()
+        pstats.Stats(self.profiler, stream=stream).sort_stats(sort).print_stats(limit)
+        print(stream.getvalue())
+
+    def __str__(self):
+        stats = self.to_dict()
+        phases = " ".join("{}:{:0.3f}s".format(phase.capitalize(), t) for phase, t in stats["times"].items())
+        return "Time:{time:0.2f} Nodes:{nodes} NPS:{nps:0.2f} MaxDepth:{max_depth} TerminalHits:{terminal_hits} " \
+               "CacheHits:{cache_hits} MeanBatch:{mean_batch_size:0.2f} ".format(**stats) + phases
+
+
+class JsonLinesSink:
+    """
+    Appends one JSON object per search to a JSON lines file
+    """
+
+    def __init__(self, filename):
+        self.file = open(filename, 'a')
+
+    def write(self, stats: SearchStats, **fields):
+        """
+        :param stats: The SearchStats of the search
+        :param fields: Additional fields of the record, e.g. the ply
+        """
+        self.file.write(json.dumps({**fields, **stats.to_dict()}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
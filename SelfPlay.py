@@ -0,0 +1,285 @@
+import multiprocessing as mp
+import queue
+import random
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+from Board import Board, boards_to_numpy
+from MCTNode import MCTSNode
+from EvaluationCache import EvaluationCache
+from NNSearch import nn_search, sample_best_move
+from NumpyNetwork import NumpyNetwork
+from GameRecord import GameRecordWriter
+from TrainingShards import ShardWriter
+from EndgameSolver import EndgameSolver
+from OpeningBook import load_book
+from SearchStats import phase_timer
+
+input_shape = Board.tensor_shape
+
+
+class InferenceBuffers:
+    """
+    Shared memory block through which one worker exchanges boards and evaluations with the inference server
+    inputs : (max_batch, 6, 9, 9) int8 encoded boards written by the worker
+    policy : (max_batch, 9, 9) float32 policy maps written by the server
+    value  : (max_batch,) float32 values written by the server
+    """
+
+    def __init__(self, max_batch, name=None):
+        """
+        Creates a new shared memory block, or attaches to an existing one
+        :param max_batch: Max number of boards per request
+        :param name: Name of an existing block to attach to
+        """
+        self.max_batch = max_batch
+        sizes = [max_batch * int(np.prod(input_shape)), max_batch * 81 * 4, max_batch * 4]
+        self.memory = shared_memory.SharedMemory(name=name, create=name is None, size=sum(sizes))
+        self.inputs = np.ndarray((max_batch,) + input_shape, dtype=np.int8, buffer=self.memory.buf)
+        self.policy = np.ndarray((max_batch, 9, 9), dtype=np.float32, buffer=self.memory.buf, offset=sizes[0])
+        self.value = np.ndarray((max_batch,), dtype=np.float32, buffer=self.memory.buf, offset=sizes[0] + sizes[1])
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def close(self):
+        # Drop the array views first, the memory cannot be closed while they export its buffer
+        del self.inputs, self.policy, self.value
+        self.memory.close()
+
+
+class RemoteNetwork:
+    """
+    Worker side stand-in for NeuralNetwork that forwards evaluations to the inference server
+    """
+
+    def __init__(self, worker_id, buffers: InferenceBuffers, requests, response):
+        """
+        :param worker_id: Index of the worker
+        :param buffers: The InferenceBuffers of the worker
+        :param requests: Queue of (worker_id, count) requests read by the server
+        :param response: Receiving end of the pipe the server signals completed requests on
+        """
+        self.worker_id = worker_id
+        self.buffers = buffers
+        self.requests = requests
+        self.response = response
+
+    def predict(self, board):
+        return self.predict_batch([board])
+
+    def predict_batch(self, boards, stats=None):
+        n = len(boards)
+        if n > self.buffers.max_batch:
+            raise ValueError("Batch of {} boards exceeds the shared buffer of {}".format(n, self.buffers.max_batch))
+        with phase_timer(stats, "encoding"):
+            boards_to_numpy(boards, self.buffers.inputs[:n])
+        # The wait for the server, including the batching with the requests of other workers
+        with phase_timer(stats, "inference"):
+            self.requests.put((self.worker_id, n))
+            self.response.recv()
+        return self.buffers.policy[:n].copy(), self.buffers.value[:n].reshape((n, 1)).copy()
+
+
+def load_network(model_file):
+    """
+    :param model_file: Model file of the NeuralNetwork, None for a new network, a .npz file exported by
+                       NeuralNetwork.export_numpy or written by QuantizedNetwork.quantize is evaluated in NumPy
+                       without loading Keras
+    :return: The network
+    """
+    if model_file is None or not model_file.endswith('.npz'):
+        from NeuralNetwork import NeuralNetwork
+
+        return NeuralNetwork(model_file)
+    with np.load(model_file) as data:
+        quantized = "mode" in data.files
+    if quantized:
+        from QuantizedNetwork import QuantizedNetwork
+
+        return QuantizedNetwork(model_file)
+    return NumpyNetwork(model_file)
+
+
+def run_inference_server(model_file, buffer_names, max_batch, requests, responses, max_wait, cache_capacity=0):
+    """
+    Owns the NeuralNetwork and evaluates the requests of all workers, batching requests that arrive
+    within max_wait seconds of the first pending one
+    :param model_file: Model file of the network, see load_network
+    :param buffer_names: Shared memory names of the InferenceBuffers of every worker
+    :param max_batch: Max number of boards per worker request
+    :param requests: Queue of (worker_id, count) requests, None stops the server
+    :param responses: Sending ends of the pipes of every worker
+    :param max_wait: Max seconds a request waits for other requests to join its batch
+    :param cache_capacity: Max number of evaluations cached across all workers and games, 0 disables the cache
+    """
+    nn = load_network(model_file)
+    if cache_capacity > 0:
+        nn = EvaluationCache(nn, capacity=cache_capacity, symmetries=True)
+    buffers = [InferenceBuffers(max_batch, name) for name in buffer_names]
+    batch_limit = max_batch * len(buffers)
+    running = True
+    while running:
+        request = requests.get()
+        if request is None:
+            break
+        pending = [request]
+        count = request[1]
+        deadline = time.time() + max_wait
+        while count < batch_limit:
+            try:
+                request = requests.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                break
+            if request is None:
+                running = False
+                break
+            pending.append(request)
+            count += request[1]
+        x = np.concatenate([buffers[worker_id].inputs[:n] for worker_id, n in pending])
+        p, v = nn.predict_numpy(x)
+        offset = 0
+        for worker_id, n in pending:
+            buffers[worker_id].policy[:n] = p[offset:offset + n]
+            buffers[worker_id].value[:n] = v[offset:offset + n, 0]
+            offset += n
+            responses[worker_id].send(n)
+    if cache_capacity > 0:
+        print(nn)
+    for b in buffers:
+        b.close()
+
+
+def play_game(nn, max_nodes=800, batch_size=8, timeout=float('inf'), endgame_threshold=0, book=None,
+              book_temperature=1.0):
+    """
+    Plays a game of nn_search against itself
+    :param nn: The neural network for evaluation
+    :param max_nodes: Max nodes searched per move
+    :param batch_size: Leaves evaluated per call to the neural network
+    :param timeout: Timeout duration per move in seconds
+    :param endgame_threshold: Number of empty cells below which positions are solved by an EndgameSolver,
+                              the samples of proven positions hold the exact result, 0 disables the solver
+    :param book: Optional OpeningBook the moves of the book positions are sampled from without searching
+    :param book_temperature: Temperature of the sampling of the book moves
+    :return: A list of (input, policy, value) training samples, one per move, the game result and the moves played
+    """
+    b = Board()
+    n = MCTSNode(b)
+    solver = EndgameSolver(endgame_threshold) if endgame_threshold > 0 else None
+    samples = []
+    while not b.is_game_over():
+        move = None if book is None else book.sample_move(b, book_temperature)
+        if move is not None:
+            samples.append(book.get_training_data(b))
+        else:
+            n = nn_search(n, nn, timeout=timeout, max_nodes=max_nodes, batch_size=batch_size, verbose=False,
+                          solver=solver)
+            samples.append(n.to_numpy_training_data())
+            move = sample_best_move(n)
+        b.move(move)
+        n = n.advance(move)
+    return samples, b.get_game_result(), b.move_list
+
+
+def run_worker(worker_id, buffer_name, max_batch, requests, response, games, results, search_args, seed):
+    """
+    Plays games until the game queue is exhausted
+    :param worker_id: Index of the worker
+    :param buffer_name: Shared memory name of the InferenceBuffers of the worker
+    :param max_batch: Max number of boards per request
+    :param requests: Queue of requests read by the inference server
+    :param response: Receiving end of the pipe the server signals completed requests on
+    :param games: Queue of game numbers to play, None stops the worker
+    :param results: Queue the (samples, result, moves) of every game is put on
+    :param search_args: Keyword arguments of play_game
+    :param seed: Seed of the move sampling
+    """
+    random.seed(seed)
+    buffers = InferenceBuffers(max_batch, buffer_name)
+    nn = RemoteNetwork(worker_id, buffers, requests, response)
+    while games.get() is not None:
+        results.put(play_game(nn, **search_args))
+    buffers.close()
+
+
+def generate(model_file=None, workers=4, games=8, max_nodes=800, batch_size=8, max_wait=0.005, seed=0,
+             cache_capacity=1 << 16, writer=None, records=None, endgame_threshold=0, book=None, book_temperature=1.0):
+    """
+    Generates self-play games with several worker processes sharing one inference server process
+    :param model_file: Model file of the NeuralNetwork, None for a new network
+    :param workers: Number of worker processes playing games
+    :param games: Number of games to play
+    :param max_nodes: Max nodes searched per move
+    :param batch_size: Leaves evaluated per call to the neural network by each worker
+    :param max_wait: Max seconds the server waits to fill a batch
+    :param seed: Seed of the workers, worker i uses seed + i
+    :param cache_capacity: Max number of evaluations cached by the inference server, 0 disables the cache
+    :param writer: Optional ShardWriter every game is written to as soon as it is finished
+    :param records: Optional GameRecordWriter every game is recorded to as soon as it is finished
+    :param endgame_threshold: Number of empty cells below which positions are solved, 0 disables the solver
+    :param book: Optional OpeningBook the openings are sampled from
+    :param book_temperature: Temperature of the sampling of the book moves
+    :return: A list of (samples, result) of every game, with samples None for the games given to the writer
+    """
+    ctx = mp.get_context('spawn')
+    requests = ctx.Queue()
+    game_queue = ctx.Queue()
+    results = ctx.Queue()
+    pipes = [ctx.Pipe(duplex=False) for _ in range(workers)]
+    buffers = [InferenceBuffers(batch_size) for _ in range(workers)]
+    server = ctx.Process(target=run_inference_server,
+                         args=(model_file, [b.name for b in buffers], batch_size, requests,
+                               [send for _, send in pipes], max_wait, cache_capacity))
+    server.start()
+    search_args = {"max_nodes": max_nodes, "batch_size": batch_size, "endgame_threshold": endgame_threshold,
+                   "book": book, "book_temperature": book_temperature}
+    processes = [ctx.Process(target=run_worker,
+                             args=(i, buffers[i].name, batch_size, requests, pipes[i][0], game_queue, results,
+                                   search_args, seed + i))
+                 for i in range(workers)]
+    for p in processes:
+        p.start()
+    for i in range(games):
+        game_queue.put(i)
+    for _ in processes:
+        game_queue.put(None)
+    played = []
+    while len(played) < games:
+        try:
+            samples, result, moves = results.get(timeout=1)
+            if records is not None:
+                records.add_game(moves, result, samples)
+            if writer is not None:
+                writer.add_game(samples)
+                samples = None
+            played.append((samples, result))
+        except queue.Empty:
+            # A worker that exits cleanly has put all of its games, any other exit means a crash
+            if not server.is_alive() or any(p.exitcode not in (None, 0) for p in processes):
+                break
+    if len(played) < games:
+        for p in processes + [server]:
+            p.terminate()
+        for b in buffers:
+            b.close()
+            b.memory.unlink()
+        raise RuntimeError("Self-play process exited after {} of {} games".format(len(played), games))
+    for p in processes:
+        p.join()
+    requests.put(None)
+    server.join()
+    for b in buffers:
+        b.close()
+        b.memory.unlink()
+    return played
+
+
+if __name__ == '__main__':
+    start = time.time()
+    with ShardWriter('selfplay', metadata={"search": "nn_search", "max_nodes": 800, "endgame_threshold": 18}) \
+            as writer, GameRecordWriter('selfplay.games') as records:
+        played = generate(writer=writer, records=records, endgame_threshold=18, book=load_book())
+    print("Games:{} Samples:{} Time:{:0.2f}".format(len(played), writer.samples, time.time() - start))
@@ -0,0 +1,200 @@
+"""
+Game clock aware time management and pondering.
+A TimeManager splits the remaining time of a player into per-move budgets, a MoveTimer ends the search of a move
+early once the most visited root child cannot be overtaken and extends it while the two best children are close.
+A Ponderer searches the expected reply in a background thread while the opponent thinks.
+"""
+import random
+import threading
+import time
+import numpy as np
+
+from Board import Board
+from MCTNode import MCTSNode, get_last_move
+from MCTSearch import mst_search, get_best_child
+
+# Expected length of a game in plies and least number of own moves the remaining time is split over
+EXPECTED_PLIES = 60
+MIN_MOVES_LEFT = 8
+# Time kept back per move for the overhead outside of the search
+MOVE_OVERHEAD = 0.02
+# Factor of the target budget a move is extended to at most
+MAX_EXTENSION = 3.0
+# Share of the visits of the best child the second one needs to extend the search
+CLOSE_RATIO = 0.8
+
+
+class MoveTimer:
+    """
+    Time budget of one move
+    target  : seconds the search runs for when the choice is clear
+    maximum : seconds the search runs for at most, used as the timeout of the search
+    """
+
+    def __init__(self, target, maximum, check_interval=16):
+        """
+        :param target: The target duration in seconds
+        :param maximum: The max duration in seconds
+        :param check_interval: Number of nodes between two checks of the root children
+        """
+        self.start = time.perf_counter()
+        self.target = target
+        self.maximum = maximum
+        self.check_interval = check_interval
+        self.next_check = 0
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def should_stop(self, root: MCTSNode, nodes):
+        """
+        Stop condition of mst_search and nn_search
+        :param root: The root of the search
+        :param nodes: Number of nodes searched so far
+        :return: True when the search should end
+        """
+        if nodes < self.next_check:
+            return False
+        self.next_check = nodes + self.check_interval
+        elapsed = self.elapsed()
+        if root.is_leaf() or nodes == 0 or elapsed <= 0:
+            return elapsed >= self.target
+        tree = root.tree
+        start = int(tree.first_child[root.index])
+        visits = tree.visits[start:start + int(tree.child_count[root.index])]
+        if len(visits) < 2:
+            return True
+        second, best = np.partition(visits, len(visits) - 2)[-2:]
+        if elapsed >= self.target:
+            # Extend while the two best moves are close
+            return best == 0 or second < CLOSE_RATIO * best or elapsed >= self.maximum
+        # Nodes left until the target at the current speed, all of them going to the second child cannot catch up
+        remaining = nodes / elapsed * (self.target - elapsed)
+        return best - second > remaining
+
+
+class TimeManager:
+    """
+    Clock of one player, allocating the budget of every move from the remaining time and the ply
+    """
+
+    def __init__(self, remaining, increment=0.0):
+        """
+        :param remaining: The time on the clock in seconds
+        :param increment: Seconds added to the clock after every move
+        """
+        self.remaining = remaining
+        self.increment = increment
+        self.timer = None
+
+    def start_move(self, board: Board):
+        """
+        Starts the clock for a move
+        :param board: The board of the move
+        :return: The MoveTimer of the move
+        """
+        moves_left = max(MIN_MOVES_LEFT, (EXPECTED_PLIES - board.plies()) / 2)
+        available = max(self.remaining - MOVE_OVERHEAD, 0)
+        target = min(available / moves_left + self.increment, available / 2)
+        maximum = min(target * MAX_EXTENSION, available / 2)
+        self.timer = MoveTimer(target, maximum)
+        return self.timer
+
+    def end_move(self):
+        """
+        Stops the clock, charging the time of the move and adding the increment
+        :return: The time the move took
+        """
+        elapsed = self.timer.elapsed()
+        self.remaining += self.increment - elapsed
+        self.timer = None
+        return elapsed
+
+    def is_flagged(self):
+        return self.remaining < 0
+
+
+class Ponderer:
+    """
+    Searches the position after the expected reply of the opponent in a background thread, the pondered tree
+    becomes the new root when the opponent plays that reply
+    """
+
+    def __init__(self, search):
+        """
+        :param search: Function of a root and a stop function running a search until stopped and returning the root,
+                       e.g. lambda root, stop: nn_search(root, nn, timeout=float('inf'), max_nodes=1e6, stop=stop)
+        """
+        self.search = search
+        self.thread = None
+        self.stopped = threading.Event()
+        self.expected_move = None
+        self.root = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self, root: MCTSNode):
+        """
+        Starts pondering
+        :param root: The root after the own move, with the opponent to move
+        """
+        if root.is_terminal_node() or root.is_leaf():
+            return
+        self.expected_move = get_last_move(get_best_child(root))
+        self.root = root.advance(self.expected_move)
+        if self.root.is_terminal_node():
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        self.root = self.search(self.root, lambda root, nodes: self.stopped.is_set())
+
+    def stop(self, root: MCTSNode, move):
+        """
+        Stops pondering once the opponent moved
+        :param root: The root pondering was started from
+        :param move: The move the opponent played
+        :return: The new root, the pondered tree when the move was the expected one
+        """
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+        if self.root is None:
+            return root.advance(move)
+        pondered = self.root
+        self.root = None
+        if move == self.expected_move:
+            self.hits += 1
+            return pondered
+        self.misses += 1
+        return root.advance(move)
+
+
+if __name__ == '__main__':
+    # mst_search under a 60 second clock, pondering while a fixed time mst_search opponent thinks
+    random.seed(0)
+    b = Board()
+    clock = TimeManager(60.0, increment=0.5)
+    ponderer = Ponderer(lambda root, stop: mst_search(root, timeout=float('inf'), max_nodes=1e6, stop=stop))
+    n = MCTSNode(b)
+    while not b.is_game_over():
+        if b.is_white_to_move():
+            timer = clock.start_move(b)
+            n = mst_search(n, timeout=timer.maximum, max_nodes=1e6, stop=timer.should_stop)
+            move = get_last_move(get_best_child(n))
+            visits = n.visits
+            print("Ply:{} Time:{:0.2f} Target:{:0.2f} Max:{:0.2f} Visits:{} Clock:{:0.2f}".format(
+                b.plies(), clock.end_move(), timer.target, timer.maximum, visits, clock.remaining))
+            b.move(move)
+            n = n.advance(move)
+            ponderer.start(n)
+        else:
+            move = get_last_move(get_best_child(mst_search(MCTSNode(b), timeout=1, max_nodes=1e6)))
+            b.move(move)
+            n = ponderer.stop(n, move)
+            print("Reused Visits:{}".format(n.visits))
+    print(b)
+    print("Result:{} Ponder Hits:{} Misses:{}".format(b.get_game_result(), ponderer.hits, ponderer.misses))
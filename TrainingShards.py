@@ -0,0 +1,179 @@
+"""
+Sharded on-disk storage of training samples.
+Every shard is a directory of .npy arrays holding up to shard_size canonical samples:
+    input.npy  : (N, 6, 9, 9) int8 encoded boards
+    policy.npy : (N, 9, 9) float16 policy targets
+    value.npy  : (N,) float16 value targets
+    game.npy   : (N,) int64 number of the game each sample comes from
+    meta.json  : sample count, game range, dtypes and user metadata
+Only the canonical orientation of a sample is stored, the 8 symmetries are generated when reading.
+"""
+import json
+import os
+import time
+import numpy as np
+
+from Board import Board
+from Utils import generate_symmetries, apply_symmetry
+
+SHARD_FORMAT = 1
+SHARD_ARRAYS = {"input": np.int8, "policy": np.float16, "value": np.float16, "game": np.int64}
+
+
+def list_shards(directory):
+    """
+    :param directory: The directory of the shards
+    :return: The paths of the complete shards in the directory in the order they were written
+    """
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, name) for name in sorted(os.listdir(directory))
+            if name.startswith("shard_") and os.path.isfile(os.path.join(directory, name, "meta.json"))]
+
+
+def read_metadata(shard):
+    with open(os.path.join(shard, "meta.json")) as f:
+        return json.load(f)
+
+
+def read_shard(shard, mmap=True):
+    """
+    Reads the arrays of a shard
+    :param shard: The path of the shard
+    :param mmap: Memory-map the arrays instead of loading them
+    :return: A dict of the input, policy, value and game arrays
+    """
+    mode = 'r' if mmap else None
+    return {name: np.load(os.path.join(shard, name + ".npy"), mmap_mode=mode) for name in SHARD_ARRAYS}
+
+
+class ShardWriter:
+    """
+    Streams training samples into fixed size shards, a shard is written as soon as it is full so a crash
+    only loses the samples of the current shard. Writing resumes after the shards already in the directory.
+    """
+
+    def __init__(self, directory, shard_size=1 << 14, metadata=None):
+        """
+        :param directory: The directory of the shards, created if missing
+        :param shard_size: Number of samples per shard
+        :param metadata: Optional dict stored in the metadata of every shard, e.g. the search settings
+        """
+        self.directory = directory
+        self.shard_size = shard_size
+        self.metadata = {} if metadata is None else metadata
+        os.makedirs(directory, exist_ok=True)
+        shards = list_shards(directory)
+        self.shard_index = len(shards)
+        self.game = read_metadata(shards[-1])["last_game"] + 1 if len(shards) > 0 else 0
+        self.buffers = {name: np.empty((shard_size,) + shape, dtype=SHARD_ARRAYS[name])
+                        for name, shape in (("input", Board.tensor_shape), ("policy", (9, 9)), ("value", ()),
+                                            ("game", ()))}
+        self.size = 0
+        # Samples added by this writer
+        self.samples = 0
+
+    def add(self, input_board, p, v):
+        """
+        Adds one canonical sample of the current game
+        :param input_board: A (6, 9, 9) encoded board
+        :param p: A (9, 9) policy target
+        :param v: The value target
+        """
+        self.buffers["input"][self.size] = input_board
+        self.buffers["policy"][self.size] = p
+        self.buffers["value"][self.size] = v
+        self.buffers["game"][self.size] = self.game
+        self.size += 1
+        self.samples += 1
+        if self.size == self.shard_size:
+            self.flush()
+
+    def end_game(self):
+        self.game += 1
+
+    def add_game(self, samples):
+        """
+        Adds the samples of a complete game
+        :param samples: A list of (input, policy, value) samples
+        """
+        for input_board, p, v in samples:
+            self.add(input_board, p, v)
+        self.end_game()
+
+    def flush(self):
+        """
+        Writes the buffered samples as a new shard
+        """
+        if self.size == 0:
+            return
+        name = "shard_{:06d}".format(self.shard_index)
+        path = os.path.join(self.directory, name)
+        # Written under a temporary name and renamed when complete, readers never see partial shards
+        tmp_path = os.path.join(self.directory, "tmp_" + name)
+        os.makedirs(tmp_path, exist_ok=True)
+        for array_name, buffer in self.buffers.items():
+            np.save(os.path.join(tmp_path, array_name + ".npy"), buffer[:self.size])
+        games = self.buffers["game"][:self.size]
+        metadata = {"format": SHARD_FORMAT,
+                    "samples": self.size,
+                    "first_game": int(games[0]),
+                    "last_game": int(games[-1]),
+                    "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "dtypes": {array_name: np.dtype(dtype).name for array_name, dtype in SHARD_ARRAYS.items()},
+                    "metadata": self.metadata}
+        with open(os.path.join(tmp_path, "meta.json"), 'w') as f:
+            json.dump(metadata, f, indent=2)
+        os.rename(tmp_path, path)
+        self.shard_index += 1
+        self.size = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def augment(input_board, p, symmetry):
+    """
+    Applies one of the 8 symmetries of generate_symmetries to a sample
+    :param input_board: A (6, 9, 9) encoded board
+    :param p: A (9, 9) policy target
+    :param symmetry: Index of the symmetry
+    :return: The transformed input and policy
+    """
+    return apply_symmetry(input_board, symmetry, axes=(1, 2)), apply_symmetry(p, symmetry)
+
+
+def iterate_samples(directory, symmetries=True):
+    """
+    Reads the samples of every shard of a directory one shard at a time
+    :param directory: The directory of the shards
+    :param symmetries: Yield the 8 symmetries of every sample instead of only the stored one
+    :return: A generator of (input, policy, value) samples
+    """
+    for shard in list_shards(directory):
+        data = read_shard(shard, mmap=False)
+        for input_board, p, v in zip(data["input"], data["policy"], data["value"]):
+            if symmetries:
+                for s_input, s_p in zip(generate_symmetries(input_board, axes=(1, 2)), generate_symmetries(p)):
+                    yield s_input, s_p, v
+            else:
+                yield input_board, p, v
+
+
+def load_training_data(directory, symmetries=True):
+    """
+    Loads every sample of a directory into memory in the layout of the former np.savez files
+    :param directory: The directory of the shards
+    :param symmetries: Include the 8 symmetries of every sample
+    :return: A dict of input, output_p and output_v arrays
+    """
+    samples = list(iterate_samples(directory, symmetries))
+    return {"input": np.array([s[0] for s in samples]),
+            "output_p": np.array([s[1] for s in samples], dtype=np.float32),
+            "output_v": np.array([s[2] for s in samples], dtype=np.float32)}
@@ -0,0 +1,92 @@
+from collections import OrderedDict
+
+
+class TTEntry:
+    """
+    Statistics shared by every node that reaches the same position
+    visits : number of results recorded for the position
+    wins   : sum of the results from white's perspective
+    policy : cached (9, 9) policy map of the neural network
+    value  : cached value of the neural network
+    """
+    __slots__ = ('visits', 'wins', 'policy', 'value')
+
+    def __init__(self):
+        self.visits = 0
+        self.wins = 0.0
+        self.policy = None
+        self.value = None
+
+    def get_mean_result(self):
+        return self.wins / self.visits
+
+
+class TranspositionTable:
+    """
+    Bounded table of TTEntry keyed by Board.hash with least recently used eviction
+    """
+
+    def __init__(self, capacity=1 << 18):
+        """
+        Initializes an empty transposition table
+        :param capacity: Max number of entries kept before the least recently used one is evicted
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def probe(self, key):
+        """
+        Looks up a position
+        :param key: The Zobrist hash of the position
+        :return: The TTEntry of the position or None if it is not stored
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def get_or_create(self, key):
+        """
+        Looks up a position and stores an empty entry for it when missing
+        :param key: The Zobrist hash of the position
+        :return: The TTEntry of the position
+        """
+        entry = self.probe(key)
+        if entry is None:
+            entry = TTEntry()
+            self.store(key, entry)
+        return entry
+
+    def store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_rate(self):
+        probes = self.hits + self.misses
+        return self.hits / probes if probes > 0 else 0.0
+
+    def stats(self):
+        return {"entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hit_rate(),
+                "evictions": self.evictions}
+
+    def __str__(self):
+        return "TT Entries:{entries} Hits:{hits} Misses:{misses} HitRate:{hit_rate:0.2%} Evictions:{evictions}" \
+            .format(**self.stats())
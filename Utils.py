@@ -18,3 +18,30 @@ def generate_symmetries(array, axes=(0, 1)):
         np.rot90(flipped_array, 2, axes),
         np.rot90(flipped_array, 3, axes)
     ]
+
+
+def apply_symmetry(array, index, axes=(0, 1)):
+    """
+    Applies a single symmetry of generate_symmetries
+    :param array: The array to transform
+    :param index: Index of the symmetry in the list returned by generate_symmetries
+    :param axes: The two axes spanning the board
+    :return: The transformed array
+    """
+    if index >= 4:
+        array = np.flip(array, axes[0])
+    return np.rot90(array, index % 4, axes)
+
+
+def invert_symmetry(array, index, axes=(0, 1)):
+    """
+    Reverts apply_symmetry
+    :param array: The transformed array
+    :param index: Index of the symmetry that was applied
+    :param axes: The two axes spanning the board
+    :return: The array before the symmetry was applied
+    """
+    array = np.rot90(array, -(index % 4), axes)
+    if index >= 4:
+        array = np.flip(array, axes[0])
+    return array